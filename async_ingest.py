@@ -0,0 +1,322 @@
+"""
+asyncio based alternative to common.s3_to_es.
+
+The S3 read and transform run on a worker thread, feeding bulk chunks through
+a bounded queue to the event loop. The event loop keeps several bulk requests
+in flight at once over a SigV4 signed aiohttp session, so network time
+overlaps with parsing without the memory cost of extra processes.
+"""
+
+import asyncio
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import logging
+
+import aiohttp
+import botocore.auth  # type: ignore
+import botocore.awsrequest  # type: ignore
+import botocore.credentials  # type: ignore
+import elasticsearch  # type: ignore
+
+import common
+
+logger = logging.getLogger()
+
+# One bulk chunk: the serialized NDJSON body plus the documents it contains,
+# kept so errors can be reported against the original document.
+BulkChunk = Tuple[bytes, List[common.EsDocument]]
+
+# Share chunking and retry settings with the synchronous path
+_BULK_OPTS = common._ES_STREAM_BULK_OPTS  # pylint: disable=protected-access
+_UNAVAILABLE_STATUSES = (
+    common._ES_UNAVAILABLE_STATUSES  # pylint: disable=protected-access
+)
+
+
+def _chunk_documents(
+    documents: Iterable[common.EsDocument],
+    chunk_size: int = _BULK_OPTS["chunk_size"],
+    max_chunk_bytes: int = _BULK_OPTS["max_chunk_bytes"],
+) -> Iterator[BulkChunk]:
+    """Serialize documents into bulk request bodies, respecting size limits."""
+    lines: List[bytes] = []
+    docs: List[common.EsDocument] = []
+    size = 0
+    for doc in documents:
+        data = common._bulk_lines(doc)  # pylint: disable=protected-access
+        if docs and (len(docs) == chunk_size or size + len(data) > max_chunk_bytes):
+            yield b"".join(lines), docs
+            lines, docs, size = [], [], 0
+        lines.append(data)
+        docs.append(doc)
+        size += len(data)
+    if docs:
+        yield b"".join(lines), docs
+
+
+class AsyncBulkClient:
+    """Minimal async Elasticsearch bulk client with SigV4 request signing."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        host: str,
+        region: str,
+        credentials: botocore.credentials.Credentials,
+        port: int = 443,
+        timeout: float = 60,
+    ) -> None:
+        self.url = "https://%s:%s/_bulk" % (host, port)
+        self.signer = botocore.auth.SigV4Auth(credentials, "es", region)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "AsyncBulkClient":
+        self.session = aiohttp.ClientSession(timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *_exc: Any) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _signed_headers(self, body: bytes) -> Dict[str, str]:
+        request = botocore.awsrequest.AWSRequest(
+            method="POST",
+            url=self.url,
+            data=body,
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        self.signer.add_auth(request)
+        return dict(request.headers.items())
+
+    async def bulk(self, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        """POST one bulk body. Returns (HTTP status, parsed response)."""
+        assert self.session is not None, "Use AsyncBulkClient as a context manager"
+        async with self.session.post(
+            self.url, data=body, headers=self._signed_headers(body)
+        ) as response:
+            try:
+                return response.status, await response.json(content_type=None)
+            except ValueError:
+                # Proxies return HTML or plain text bodies for eg 502s
+                if response.status < 300:
+                    raise
+                return response.status, {"error": await response.text()}
+
+
+def _report_errors(
+    resp: Dict[str, Any],
+    docs: List[common.EsDocument],
+    spool_fn: Optional[common.SpoolFn] = None,
+    retry: Optional[List[common.EsDocument]] = None,
+) -> int:
+    """
+    Log or spool failed items in a bulk response. Returns the failure count.
+
+    If `retry` is given, throttled (429) documents are added to it instead,
+    and don't count as failures.
+    """
+    if not resp.get("errors"):
+        return 0
+    failed = 0
+    for item, doc in zip(resp.get("items", []), docs):
+        # Each item is keyed by its op type, eg {"index": {...}}
+        result = next(iter(item.values()))
+        if 200 <= result.get("status", 500) < 300:
+            continue
+        if retry is not None and result.get("status") == 429:
+            retry.append(doc)
+            continue
+        failed += 1
+        if spool_fn is not None and result.get("status") in _UNAVAILABLE_STATUSES:
+            spool_fn(doc)
+            continue
+        logger.warning(
+            "Error from Elasticsearch, continuing: %r (original document: %r)",
+            result,
+            doc,
+        )
+    return failed
+
+
+async def _send_chunk(
+    client: AsyncBulkClient,
+    chunk: BulkChunk,
+    spool_fn: Optional[common.SpoolFn] = None,
+) -> int:
+    """
+    Send one chunk, retrying with backoff on throttling. Returns documents
+    sent.
+
+    As with elasticsearch.helpers.streaming_bulk, both a throttled request and
+    throttled items of an accepted request are retried.
+    """
+    body, docs = chunk
+    backoff = _BULK_OPTS["initial_backoff"]
+    sent = 0
+    for attempt in range(_BULK_OPTS["max_retries"] + 1):
+        if attempt:
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, _BULK_OPTS["max_backoff"])
+        try:
+            status, resp = await client.bulk(body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Same policy as common._es_streaming_wrapper: log and carry on
+            logger.warning("Error from Elasticsearch: %s. Will continue processing.", e)
+            if spool_fn is not None:
+                for doc in docs:
+                    spool_fn(doc)
+            return sent
+        last_attempt = attempt == _BULK_OPTS["max_retries"]
+        if status == 429 and not last_attempt:
+            continue
+        if status in _UNAVAILABLE_STATUSES and spool_fn is not None:
+            for doc in docs:
+                spool_fn(doc)
+            return sent
+        if status >= 300 and "items" not in resp:
+            logger.warning("Error from Elasticsearch, continuing: %s %r", status, resp)
+            return sent
+        retry: List[common.EsDocument] = []
+        failed = _report_errors(
+            resp, docs, spool_fn, retry if not last_attempt else None
+        )
+        sent += len(docs) - failed - len(retry)
+        if not retry:
+            return sent
+        docs = retry
+        body = b"".join(
+            common._bulk_lines(doc) for doc in docs  # pylint: disable=protected-access
+        )
+    return sent
+
+
+class _Diverter:  # pylint: disable=too-few-public-methods
+    """
+    Spool function which notes that Elasticsearch looked unavailable, so the
+    remaining chunks can go straight to the spool as on the synchronous path.
+    """
+
+    def __init__(self, spool_fn: common.SpoolFn) -> None:
+        self.spool_fn = spool_fn
+        self.unavailable = False
+        self.spooled = 0
+
+    def __call__(self, doc: common.EsDocument) -> None:
+        if not self.unavailable:
+            logger.warning("Elasticsearch unavailable, spooling remaining documents")
+            self.unavailable = True
+        self.spool_fn(doc)
+        self.spooled += 1
+
+
+async def _sender(
+    client: AsyncBulkClient,
+    queue: "asyncio.Queue[Any]",
+    diverter: Optional[_Diverter] = None,
+) -> int:
+    sent = 0
+    while True:
+        chunk = await queue.get()
+        if chunk is None:
+            return sent
+        if diverter is not None and diverter.unavailable:
+            for doc in chunk[1]:
+                diverter(doc)
+            continue
+        sent += await _send_chunk(client, chunk, diverter)
+
+
+async def s3_to_es(  # pylint: disable=too-many-arguments,too-many-locals
+    bucket: str,
+    key: str,
+    transform_fn: common.TransformFn,
+    client: AsyncBulkClient,
+    line_filter: Optional[common.LineFilterFn] = None,
+    doc_filter: Optional[common.DocFilterFn] = None,
+    index_settings: Optional[Dict[str, Any]] = None,
+    es_client: Optional[elasticsearch.Elasticsearch] = None,
+    spool_fn: Optional[common.SpoolFn] = None,
+    start_line: int = 0,
+    max_in_flight: int = 4,
+) -> None:
+    """
+    Index lines in an S3 file into Elasticsearch using asyncio.
+
+    Arguments match common.s3_to_es, except the connection is an entered
+    AsyncBulkClient. Up to `max_in_flight` bulk requests run concurrently.
+    Creating indexes with `index_settings` is a rare, blocking call, so it
+    needs a synchronous `es_client` and runs on the worker thread.
+    `spool_fn` is only ever called from the event loop thread. Once a
+    document has been spooled, the remaining chunks are spooled without being
+    sent. Lines before
+    `start_line` are skipped, but no new checkpoints are recorded as bulk
+    requests complete out of order.
+    """
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=max_in_flight)
+    stop = threading.Event()
+
+    def put(item: Optional[BulkChunk]) -> None:
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce() -> None:
+        # pylint: disable=protected-access
+        docs = common._prepare_documents(
+            es_client,
+            common._transform_lines(
+                common._s3_object_lines(bucket, key),
+                transform_fn,
+                line_filter,
+                doc_filter,
+                start_line,
+            ),
+            index_settings if es_client is not None else None,
+        )
+        try:
+            for chunk in _chunk_documents(docs):
+                if stop.is_set():
+                    return
+                put(chunk)
+        finally:
+            for _ in range(max_in_flight):
+                put(None)
+
+    diverter = _Diverter(spool_fn) if spool_fn is not None else None
+    producer = asyncio.ensure_future(loop.run_in_executor(None, produce))
+    senders = [
+        asyncio.ensure_future(_sender(client, queue, diverter))
+        for _ in range(max_in_flight)
+    ]
+    try:
+        counts = await asyncio.gather(*senders)
+    finally:
+        # If a sender failed, keep the queue drained so the producer thread
+        # can't block forever on a full queue.
+        stop.set()
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0.01)
+    await producer  # Re-raise transform errors
+    logger.info("Sent %s total documents to Elasticsearch", sum(counts))
+    if diverter is not None and diverter.spooled:
+        logger.info("Spooled %s documents for later replay", diverter.spooled)
+
+
+def run(  # pylint: disable=too-many-arguments
+    bucket: str,
+    key: str,
+    transform_fn: common.TransformFn,
+    host: str,
+    region: str,
+    credentials: botocore.credentials.Credentials,
+    **kwargs: Any
+) -> None:
+    """Synchronous entry point: run s3_to_es on a fresh event loop."""
+
+    async def main() -> None:
+        async with AsyncBulkClient(host, region, credentials) as client:
+            await s3_to_es(bucket, key, transform_fn, client, **kwargs)
+
+    asyncio.run(main())
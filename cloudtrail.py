@@ -1,8 +1,10 @@
-from typing import Iterable, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 import json
+import logging
 import re
 
 import flatten_dict  # type: ignore
+import pylru  # type: ignore
 
 import common
 
@@ -19,6 +21,85 @@ PREDEFINED_MAPPINGS = {
 }
 STRING_FIELDS = set(["aws.cloudtrail.response_elements.version"])
 
+# Free-form sections of a record. Their contents vary by API call and can
+# create thousands of fields, so only allowlisted paths get their own field.
+BUDGETED_SECTIONS = (
+    "requestParameters",
+    "responseElements",
+    "additionalEventData",
+    "serviceEventDetails",
+)
+# Section paths which get their own field. Every eventSource writes to the
+# same daily index, so this is the whole budget for the index, and the same
+# for every container. Other paths go into one overflow field per section.
+SECTION_FIELDS = frozenset(
+    [
+        "requestParameters.bucketName",
+        "requestParameters.key",
+        "requestParameters.name",
+        "requestParameters.policy",
+        "requestParameters.policyArn",
+        "requestParameters.policyName",
+        "requestParameters.userName",
+        "requestParameters.groupName",
+        "requestParameters.roleName",
+        "requestParameters.roleArn",
+        "requestParameters.roleSessionName",
+        "requestParameters.durationSeconds",
+        "requestParameters.accessKeyId",
+        "requestParameters.functionName",
+        "requestParameters.tableName",
+        "requestParameters.queueUrl",
+        "requestParameters.topicArn",
+        "requestParameters.secretId",
+        "requestParameters.keyId",
+        "requestParameters.stackName",
+        "requestParameters.clusterName",
+        "requestParameters.repositoryName",
+        "requestParameters.logGroupName",
+        "requestParameters.trailName",
+        "requestParameters.dBInstanceIdentifier",
+        "requestParameters.instanceType",
+        "requestParameters.instancesSet.items.0.instanceId",
+        "requestParameters.groupId",
+        "requestParameters.vpcId",
+        "requestParameters.subnetId",
+        "responseElements.ConsoleLogin",
+        "responseElements.version",
+        "responseElements.assumedRoleUser.arn",
+        "responseElements.assumedRoleUser.assumedRoleId",
+        "responseElements.credentials.accessKeyId",
+        "responseElements.credentials.expiration",
+        "responseElements.accessKey.accessKeyId",
+        "responseElements.instancesSet.items.0.instanceId",
+        "additionalEventData.MFAUsed",
+        "additionalEventData.LoginTo",
+        "additionalEventData.MobileVersion",
+        "additionalEventData.SignatureVersion",
+        "additionalEventData.CipherSuite",
+        "additionalEventData.AuthenticationMethod",
+        "additionalEventData.bytesTransferredIn",
+        "additionalEventData.bytesTransferredOut",
+    ]
+)
+# Cap on the fields sections can add to an index: the allowlist plus an
+# overflow field per section. This leaves room for the rest of the record
+# under Elasticsearch's default limit of 1000 fields per index.
+MAX_SECTION_FIELDS_PER_INDEX = 500
+MAX_DEPTH = 4  # Levels below the section before a subtree is collapsed
+MAX_CHILDREN = 20  # Keys or list items before a subtree is collapsed
+COLLAPSED_SUFFIX = "_json"  # Distinct from the name of the original subtree
+OVERFLOW_SUFFIX = "_overflow"
+
+if len(SECTION_FIELDS) + len(BUDGETED_SECTIONS) > MAX_SECTION_FIELDS_PER_INDEX:
+    raise ValueError("SECTION_FIELDS exceeds MAX_SECTION_FIELDS_PER_INDEX")
+
+logger = logging.getLogger()
+
+# (eventSource, path) pairs of subtrees that have been collapsed, so each is
+# only logged once in a while
+_COLLAPSED = pylru.lrucache(1000)
+
 
 def elasticsearch_reducer(k1: Optional[str], k2: str) -> str:
     """Combine items with '.' as per Elastic Common Schema convention."""
@@ -43,6 +124,55 @@ def convert_cloudtrail_key(key: str) -> str:
     return re.sub(REGEX_TWO, r"\1_\2", s1).lower()
 
 
+def _flatten_section(
+    value: Any, path: str, depth: int, out: Dict[str, Any], collapsed: List[str]
+) -> None:
+    """Flatten a nested section, collapsing deep or wide subtrees to JSON."""
+    if isinstance(value, (dict, list)):
+        if depth >= MAX_DEPTH or len(value) > MAX_CHILDREN:
+            out[path + COLLAPSED_SUFFIX] = json.dumps(value, sort_keys=True)
+            collapsed.append(path)
+            return
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        for key, child in items:
+            _flatten_section(child, "%s.%s" % (path, key), depth + 1, out, collapsed)
+    elif value is not None:
+        out[path] = value
+
+
+def budget_section(
+    event_source: str, section: str, value: Any
+) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Flatten a free-form section of a record within the field budget.
+
+    Paths in SECTION_FIELDS get their own field. Other paths are kept
+    together in one JSON string field, as are subtrees that are too deep or
+    too wide.
+
+    Returns the flattened fields and the paths which were collapsed.
+    """
+    fields: Dict[str, Any] = {}
+    collapsed: List[str] = []
+    _flatten_section(value, section, 0, fields, collapsed)
+    for path in collapsed:
+        if (event_source, path) not in _COLLAPSED:
+            _COLLAPSED[(event_source, path)] = True
+            logger.info("Collapsing CloudTrail field %s for %s", path, event_source)
+    out: Dict[str, Any] = {}
+    overflow: Dict[str, Any] = {}
+    for path, field_value in fields.items():
+        if path in SECTION_FIELDS:
+            out[path] = field_value
+        else:
+            overflow[path] = field_value
+            if not path.endswith(COLLAPSED_SUFFIX):  # Already reported
+                collapsed.append(path)
+    if overflow:
+        out[section + OVERFLOW_SUFFIX] = json.dumps(overflow, sort_keys=True)
+    return out, collapsed
+
+
 def check_filename(filename: str) -> bool:
     return bool(re.match(r".*CloudTrail/.*/\d+_CloudTrail_.*.json.gz$", filename))
 
@@ -55,10 +185,27 @@ def transform(line: str, _line_no: int) -> Iterable[common.EsDocument]:
 
     for record in data["Records"]:
         doc: common.EsDocument = {}
+        sections = {
+            section: record.pop(section)
+            for section in BUDGETED_SECTIONS
+            if section in record
+        }
         # Flatten the dictionary
         record = flatten_dict.flatten(
             record, reducer=elasticsearch_reducer, enumerate_types=(list,)
         )
+        collapsed: List[str] = []
+        for section, value in sections.items():
+            fields, section_collapsed = budget_section(
+                record.get("eventSource", ""), section, value
+            )
+            record.update(fields)
+            collapsed.extend(section_collapsed)
+        if collapsed:
+            # Report what was collapsed, so it can still be searched for
+            record["collapsedFields"] = ",".join(
+                convert_cloudtrail_key(path) for path in collapsed
+            )
         for key, value in record.items():
             if value is None:
                 continue
@@ -1,6 +1,22 @@
-import gzip
+import collections
+import functools
+import sys
+import time
 import traceback
-from typing import Iterable, Callable, Dict, Iterator, Union, TypeVar
+from typing import (
+    Any,
+    Deque,
+    Iterable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    TypeVar,
+)
 import logging
 import hashlib
 import json
@@ -10,8 +26,11 @@ import pylru  # type: ignore
 import boto3  # type: ignore
 import elasticsearch  # type: ignore
 import elasticsearch.helpers  # type: ignore
+import elasticsearch.serializer  # type: ignore
 import urllib3.exceptions  # type: ignore
 
+import inflate
+
 _ES_STREAM_BULK_OPTS = {
     "max_chunk_bytes": 90 * 1024 * 1024,  # 90mbyte
     "chunk_size": 10_000,
@@ -22,12 +41,35 @@ _ES_STREAM_BULK_OPTS = {
     "raise_on_exception": False,  # Don't re-raise exceptions if the call to es.bulk fails, just return error response
 }
 
+# Gzipped objects up to this size are read into memory, so concatenated gzip
+# members can be decompressed in parallel. Larger objects are streamed.
+_GZIP_IN_MEMORY_BYTES = 64 * 1024 * 1024
+
+# Bulk item statuses meaning Elasticsearch couldn't take the document right
+# now, rather than the document being bad. "N/A" is a connection failure.
+_ES_UNAVAILABLE_STATUSES = {429, 502, 503, 504, "N/A"}
+
 EsDocument = Dict[str, Union[str, bool, float]]
 TransformFn = Callable[[str, int], Iterable[EsDocument]]
+LineFilterFn = Callable[[str], bool]  # Return False to skip the line
+DocFilterFn = Callable[[EsDocument], bool]  # Return False to skip the document
+SpoolFn = Callable[[EsDocument], None]
+SinkFn = Callable[[Iterable[EsDocument]], None]  # Consumes a document stream
 T = TypeVar("T")  # generic type
 
 logger = logging.getLogger()
 
+_SERIALIZER = elasticsearch.serializer.JSONSerializer()
+
+# Indexes this Lambda container has already created (or found to exist), so
+# we only ask Elasticsearch once per index per container.
+_CREATED_INDEXES: Set[str] = set()
+# Error types for creating an index which already exists (ES 6, ES 5)
+_INDEX_EXISTS_ERRORS = {
+    "resource_already_exists_exception",
+    "index_already_exists_exception",
+}
+
 
 def _s3_object_lines(bucket: str, key: str) -> Iterable[str]:
     """Return lines from an S3 object in a streaming manner."""
@@ -35,10 +77,18 @@ def _s3_object_lines(bucket: str, key: str) -> Iterable[str]:
     obj = s3.Object(bucket_name=bucket, key=key)  # pylint: disable=no-member
     response = obj.get()
     logger.debug("Streaming %s bytes from S3", response["ContentLength"])
+    body = response["Body"]
     if key.endswith(".gz"):
-        stream = gzip.GzipFile(fileobj=response["Body"])
+        # Decompress on other threads; zlib releases the GIL while it works
+        if response["ContentLength"] <= _GZIP_IN_MEMORY_BYTES:
+            blocks = inflate.inflate_members(body.read())
+        else:
+            blocks = inflate.inflate_stream(
+                iter(functools.partial(body.read, inflate.BLOCK_BYTES), b"")
+            )
+        stream = inflate.split_lines(inflate.background(blocks))
     else:
-        stream = response["Body"].iter_lines()
+        stream = body.iter_lines()
     for line in stream:
         yield line.decode().strip()
     logger.debug("Finished streaming from S3")
@@ -59,22 +109,100 @@ def _hash_es_doc(doc: EsDocument) -> str:
     ).decode()
 
 
+def _bulk_lines(doc: EsDocument) -> bytes:
+    """Serialize a document into its bulk API action and source lines."""
+    action, source = elasticsearch.helpers.expand_action(doc)
+    data: bytes = _SERIALIZER.dumps(action).encode() + b"\n"
+    if source is not None:
+        data += _SERIALIZER.dumps(source).encode() + b"\n"
+    return data
+
+
 def _transform_lines(
-    lines: Iterable[str], transform_fn: TransformFn
+    lines: Iterable[str],
+    transform_fn: TransformFn,
+    line_filter: Optional[LineFilterFn] = None,
+    doc_filter: Optional[DocFilterFn] = None,
+    start_line: int = 0,
 ) -> Iterable[EsDocument]:
-    """Transform log file lines into Elasticsearch Documents, one at a time."""
+    """Transform log file lines into Elasticsearch Documents, one at a time.
+
+    Filtered lines and lines before start_line still count towards the line
+    number passed to transform_fn, so header detection based on line_no keeps
+    working."""
     for n, line in enumerate(lines):
+        if n < start_line:
+            continue
+        if line_filter is not None and not line_filter(line):
+            continue
         try:
             documents = transform_fn(line, n)
         except Exception:
             logger.exception("Failed to transform line %s (%r)", n, line)
             raise
         for doc in documents:
+            if doc_filter is not None and not doc_filter(doc):
+                continue
             if "_id" not in doc:
                 doc["_id"] = _hash_es_doc(doc)
             yield doc
 
 
+class Progress:
+    """
+    Track how far through an object Elasticsearch has responded.
+
+    Checkpoints are conservative: a checkpoint of line L means every document
+    from lines before L has had a response from Elasticsearch. Documents are
+    idempotent thanks to their _id, so resuming from a checkpoint only resends
+    a little data rather than losing any.
+    """
+
+    def __init__(
+        self,
+        start_line: int = 0,
+        on_checkpoint: Optional[Callable[[int], None]] = None,
+        interval: float = 10,
+    ) -> None:
+        self.checkpoint = start_line
+        self.on_checkpoint = on_checkpoint
+        self.interval = interval
+        self._lines_read = start_line
+        self._emitted = 0
+        # (documents emitted, line) pairs: once that many documents have had a
+        # response, every line before `line` is finished
+        self._candidates: Deque[Tuple[int, int]] = collections.deque()
+        self._last_saved = time.monotonic()
+
+    def track_lines(self, lines: Iterable[str]) -> Iterable[str]:
+        for n, line in enumerate(lines):
+            self._lines_read = n + 1
+            yield line
+
+    def track_documents(self, documents: Iterable[EsDocument]) -> Iterable[EsDocument]:
+        lines_read = self._lines_read
+        for doc in documents:
+            if self._lines_read != lines_read:
+                # A line can yield many documents, and reordering may split
+                # them across bulk chunks, so the last line read before this
+                # document isn't necessarily finished yet.
+                self._candidates.append((self._emitted, lines_read - 1))
+                lines_read = self._lines_read
+            self._emitted += 1
+            yield doc
+
+    def acknowledge(self, count: int) -> None:
+        """Record that `count` documents have had a response from Elasticsearch."""
+        while self._candidates and self._candidates[0][0] <= count:
+            self.checkpoint = max(self.checkpoint, self._candidates.popleft()[1])
+        if (
+            self.on_checkpoint is not None
+            and time.monotonic() - self._last_saved >= self.interval
+        ):
+            self.on_checkpoint(self.checkpoint)
+            self._last_saved = time.monotonic()
+
+
 def _es_streaming_wrapper(streamer: Iterator[T]) -> Iterator[T]:
     """Swallow some errors from elasticsearch.helpers.streaming_bulk.
 
@@ -108,14 +236,110 @@ def buffering_iterator(
         yield item
 
 
-def _stream_to_es(
-    es: elasticsearch.Elasticsearch, documents: Iterable[EsDocument]
+def _group_by_index(
+    documents: Iterable[EsDocument],
+    window: int = _ES_STREAM_BULK_OPTS["chunk_size"],
+) -> Iterable[EsDocument]:
+    """
+    Reorder documents so each bulk chunk holds contiguous runs per index.
+
+    Documents are collected `window` at a time and emitted grouped by
+    (_index, _routing), in the order each group was first seen. Index names
+    are interned so the many identical per-document strings share one object.
+    """
+    groups: Dict[Tuple[Any, Any], List[EsDocument]] = {}
+    pending = 0
+    for doc in documents:
+        index = doc.get("_index")
+        if isinstance(index, str):
+            index = doc["_index"] = sys.intern(index)
+        groups.setdefault((index, doc.get("_routing")), []).append(doc)
+        pending += 1
+        if pending >= window:
+            for group in groups.values():
+                yield from group
+            groups, pending = {}, 0
+    for group in groups.values():
+        yield from group
+
+
+def _ensure_indexes(
+    es: elasticsearch.Elasticsearch,
+    documents: Iterable[EsDocument],
+    settings: Dict[str, Any],
+) -> Iterable[EsDocument]:
+    """
+    Create each document's index with `settings` before its first write.
+
+    Existing indexes are left alone. If creation fails (eg the settings are
+    invalid) we log it and carry on, letting Elasticsearch auto-create the
+    index with its default settings. Failed indexes are tried again by the
+    next call, rather than for every document.
+    """
+    attempted: Set[str] = set()
+    for doc in documents:
+        index = doc.get("_index")
+        if (
+            isinstance(index, str)
+            and index not in _CREATED_INDEXES
+            and index not in attempted
+        ):
+            attempted.add(index)
+            try:
+                es.indices.create(index=index, body={"settings": {"index": settings}})
+                logger.info("Created index %s", index)
+                _CREATED_INDEXES.add(index)
+            except elasticsearch.RequestError as e:
+                if e.error in _INDEX_EXISTS_ERRORS:
+                    _CREATED_INDEXES.add(index)
+                else:
+                    logger.warning("Couldn't create index %s, continuing: %s", index, e)
+            except elasticsearch.ElasticsearchException as e:
+                logger.warning("Couldn't create index %s, continuing: %s", index, e)
+        yield doc
+
+
+def _prepare_documents(
+    es: elasticsearch.Elasticsearch,
+    documents: Iterable[EsDocument],
+    index_settings: Optional[Dict[str, Any]] = None,
+) -> Iterable[EsDocument]:
+    """Group transformed documents by index, creating indexes if configured."""
+    documents = _group_by_index(documents)
+    if index_settings:
+        documents = _ensure_indexes(es, documents, index_settings)
+    return documents
+
+
+def _stream_to_es(  # pylint: disable=too-many-locals
+    es: elasticsearch.Elasticsearch,
+    documents: Iterable[EsDocument],
+    spool_fn: Optional[SpoolFn] = None,
+    progress: Optional[Progress] = None,
+    result_fn: Optional[Callable[[bool, Optional[str]], None]] = None,
 ) -> None:
     # We buffer items as they are sent through to ES so that we can show them
     # in case ES returns an error. This requires the _id to be pre-set.
     buffer = pylru.lrucache(_ES_STREAM_BULK_OPTS["chunk_size"] * 2)
 
-    documents_bufferer = buffering_iterator(documents, buffer)
+    # Once ES looks unavailable, send the remaining documents straight to the
+    # spool instead of spending the rest of the invocation on retries.
+    unavailable = False
+    spooled = 0
+
+    def divert_when_unavailable(docs: Iterable[EsDocument]) -> Iterable[EsDocument]:
+        nonlocal spooled
+        for doc in docs:
+            if unavailable and spool_fn is not None:
+                spool_fn(doc)
+                spooled += 1
+                if result_fn is not None:
+                    doc_id = doc.get("_id")
+                    result_fn(False, doc_id if isinstance(doc_id, str) else None)
+            else:
+                yield doc
+
+    documents_bufferer = buffering_iterator(divert_when_unavailable(documents), buffer)
 
     elastic_stream = _es_streaming_wrapper(
         elasticsearch.helpers.streaming_bulk(
@@ -127,10 +351,28 @@ def _stream_to_es(
     count = 0  # if enumerate() gets zero items, it won't set this
     # Resp is a tuple: (success: bool, es_response: dict)
     for count, resp in enumerate(elastic_stream):
+        if progress is not None:
+            progress.acknowledge(count + 1)
+        if result_fn is not None:
+            result_fn(resp[0], resp[1].get("index", {}).get("_id"))
         if not resp[0]:
             # The error might not reference a document
             doc_id = resp[1].get("index", {}).get("_id")
-            if doc_id:
+            status = resp[1].get("index", {}).get("status")
+            if (
+                spool_fn is not None
+                and status in _ES_UNAVAILABLE_STATUSES
+                and doc_id in buffer
+            ):
+                if not unavailable:
+                    logger.warning(
+                        "Elasticsearch unavailable (%r), spooling remaining documents",
+                        resp,
+                    )
+                unavailable = True
+                spool_fn(buffer[doc_id])
+                spooled += 1
+            elif doc_id:
                 if doc_id in buffer:
                     original_doc = buffer[doc_id]
                     logger.warning(
@@ -148,13 +390,49 @@ def _stream_to_es(
                 logger.warning("Error from Elasticsearch, continuing: %r", resp)
 
     logger.info("Sent %s total documents to Elasticsearch", count)
+    if spooled:
+        logger.info("Spooled %s documents for later replay", spooled)
+
+
+class EsSink:  # pylint: disable=too-few-public-methods
+    """
+    Send documents to Elasticsearch. This is the sink s3_to_es uses unless
+    it's given another one.
+
+    Documents Elasticsearch is unavailable for are passed to `spool_fn`,
+    `progress` is advanced as Elasticsearch responds, and `result_fn` is
+    called with (success, _id) for each document.
+    """
+
+    def __init__(
+        self,
+        es: elasticsearch.Elasticsearch,
+        spool_fn: Optional[SpoolFn] = None,
+        progress: Optional[Progress] = None,
+        result_fn: Optional[Callable[[bool, Optional[str]], None]] = None,
+    ) -> None:
+        self.es = es
+        self.spool_fn = spool_fn
+        self.progress = progress
+        self.result_fn = result_fn
+
+    def __call__(self, documents: Iterable[EsDocument]) -> None:
+        if self.progress is not None:
+            documents = self.progress.track_documents(documents)
+        _stream_to_es(self.es, documents, self.spool_fn, self.progress, self.result_fn)
 
 
-def s3_to_es(
+def s3_to_es(  # pylint: disable=too-many-arguments
     bucket: str,
     key: str,
     transform_fn: TransformFn,
     es_client: elasticsearch.Elasticsearch,
+    line_filter: Optional[LineFilterFn] = None,
+    doc_filter: Optional[DocFilterFn] = None,
+    index_settings: Optional[Dict[str, Any]] = None,
+    spool_fn: Optional[SpoolFn] = None,
+    progress: Optional[Progress] = None,
+    sink: Optional[SinkFn] = None,
 ) -> None:
     """
     Index lines in an S3 file into Elasticsearch.
@@ -168,11 +446,102 @@ def s3_to_es(
             `line_no` is 0-indexed.
             Function signature: (line: str, line_no: int) -> Iterable[EsDocument]
         elasticsearch: The ES connection object.
+        line_filter: Optional predicate run on each raw line before
+            transform_fn. Lines it returns False for are skipped.
+        doc_filter: Optional predicate run on each document before it is
+            sent. Documents it returns False for are skipped.
+        index_settings: If set, indexes are created with these settings (eg
+            `{"refresh_interval": "30s"}`) before the first document is sent
+            to them. Ignored when `sink` is set.
+        spool_fn: If set, documents Elasticsearch is unavailable for are
+            passed to this function (eg spool.SpoolWriter.add) instead of
+            being dropped.
+        progress: If set, processing starts from `progress.checkpoint` and
+            the checkpoint is advanced as Elasticsearch responds.
+        sink: If set, documents are written here (see sinks.py) instead of
+            to an EsSink, and `es_client` is not used.
 
     Returns:
         None if successful. Raises exception if something critical went wrong.
         Errors on submitting some data to ES are printed but otherwise ignored.
     """
-    docs = _transform_lines(_s3_object_lines(bucket, key), transform_fn)
+    lines = _s3_object_lines(bucket, key)
+    start_line = 0
+    if progress is not None:
+        lines = progress.track_lines(lines)
+        start_line = progress.checkpoint
+    docs = _prepare_documents(
+        es_client,
+        _transform_lines(lines, transform_fn, line_filter, doc_filter, start_line),
+        # Other sinks don't write to es_client, so leave its indexes alone
+        index_settings if sink is None else None,
+    )
+    if sink is None:
+        sink = EsSink(es_client, spool_fn, progress)
+    sink(docs)
+
+
+def s3_objects_to_es(  # pylint: disable=too-many-arguments,too-many-locals
+    objects: Iterable[Tuple[str, str]],
+    transform_fn: TransformFn,
+    es_client: elasticsearch.Elasticsearch,
+    line_filter: Optional[LineFilterFn] = None,
+    doc_filter: Optional[DocFilterFn] = None,
+    index_settings: Optional[Dict[str, Any]] = None,
+    spool_fn: Optional[SpoolFn] = None,
+    sink: Optional[SinkFn] = None,
+) -> None:
+    """
+    Index lines from several S3 files into Elasticsearch in one bulk stream.
+
+    Many small objects sent with s3_to_es each end with a part-filled bulk
+    chunk. Here documents from every object share the stream, so chunks fill
+    up to `chunk_size`/`max_chunk_bytes`. Results are still counted per object.
+
+    Args:
+        objects: (bucket, key) pairs.
+        Other arguments are as for s3_to_es. Resuming from a checkpoint isn't
+        supported, as an object's documents are interleaved with others.
+    """
+    # The objects documents awaiting a response came from, by _id. Identical
+    # documents from different objects share an _id, so each _id holds a
+    # queue with an entry per copy, and results are attributed in order.
+    origins: Dict[str, Deque[str]] = {}
+    track_origins = sink is None
+    # Per object: [documents produced, documents with an error or spooled]
+    stats: Dict[str, List[int]] = collections.OrderedDict()
+
+    def documents() -> Iterable[EsDocument]:
+        for bucket, key in objects:
+            name = "s3://%s/%s" % (bucket, key)
+            stats[name] = [0, 0]
+            for doc in _transform_lines(
+                _s3_object_lines(bucket, key), transform_fn, line_filter, doc_filter
+            ):
+                if track_origins:
+                    origins.setdefault(str(doc["_id"]), collections.deque()).append(
+                        name
+                    )
+                stats[name][0] += 1
+                yield doc
+
+    def record_result(ok: bool, doc_id: Optional[str]) -> None:
+        names = origins.get(doc_id) if doc_id is not None else None
+        if not names:
+            return
+        name = names.popleft()
+        if not names:
+            del origins[str(doc_id)]
+        if not ok:
+            stats[name][1] += 1
+            logger.warning("Failed document %s came from %s", doc_id, name)
+
+    docs = _prepare_documents(
+        es_client, documents(), index_settings if sink is None else None
+    )
+    if sink is None:
+        sink = EsSink(es_client, spool_fn, result_fn=record_result)
+    sink(docs)
 
-    _stream_to_es(es_client, docs)
+    for name, (produced, failed) in stats.items():
+        logger.info("%s: %s documents, %s failed or spooled", name, produced, failed)
@@ -0,0 +1,123 @@
+"""
+Suppress duplicate processing of re-delivered S3 objects.
+
+S3 notifications are at-least-once and Lambda retries failed invocations.
+Each object version is identified by bucket, key, ETag and size. Finished
+objects are skipped, and partly processed objects resume from their last
+checkpoint.
+"""
+
+import abc
+import time
+from typing import Any, Dict, Optional
+import logging
+import urllib.parse
+
+import boto3  # type: ignore
+
+import common
+
+logger = logging.getLogger()
+
+DONE = "done"
+IN_PROGRESS = "in_progress"
+
+
+def object_version_id(bucket: str, key: str, etag: str, size: int) -> str:
+    return "%s/%s@%s:%s" % (bucket, key, etag, size)
+
+
+class Store(abc.ABC):
+    """Backing store for per-object processing state."""
+
+    @abc.abstractmethod
+    def get(self, object_id: str) -> Optional[Dict[str, Any]]:
+        """Return the state of an object, or None if it hasn't been seen."""
+
+    @abc.abstractmethod
+    def put(self, object_id: str, state: Dict[str, Any]) -> None:
+        """Save the state of an object."""
+
+
+class MemoryStore(Store):
+    """In-process store. Only deduplicates within one Lambda container."""
+
+    def __init__(self) -> None:
+        self.states: Dict[str, Dict[str, Any]] = {}
+
+    def get(self, object_id: str) -> Optional[Dict[str, Any]]:
+        return self.states.get(object_id)
+
+    def put(self, object_id: str, state: Dict[str, Any]) -> None:
+        self.states[object_id] = state
+
+
+class DynamoDbStore(Store):
+    """
+    DynamoDB store, shared by every container.
+
+    The table needs a string hash key named `id`. Enable TTL on the `expires`
+    attribute to clean up old entries.
+    """
+
+    def __init__(self, table: str, ttl: int = 7 * 24 * 60 * 60) -> None:
+        dynamodb = boto3.resource("dynamodb")
+        self.table = dynamodb.Table(table)  # pylint: disable=no-member
+        self.ttl = ttl
+
+    def get(self, object_id: str) -> Optional[Dict[str, Any]]:
+        item = self.table.get_item(Key={"id": object_id}, ConsistentRead=True)
+        if "Item" not in item:
+            return None
+        return {"status": item["Item"]["status"], "line": int(item["Item"]["line"])}
+
+    def put(self, object_id: str, state: Dict[str, Any]) -> None:
+        self.table.put_item(
+            Item={
+                "id": object_id,
+                "status": state["status"],
+                "line": state.get("line", 0),
+                "expires": int(time.time()) + self.ttl,
+            }
+        )
+
+
+def from_url(url: str) -> Optional[Store]:
+    """
+    Create a store from a URL like `dynamodb://table` or `memory://`.
+
+    An empty URL disables deduplication.
+    """
+    if not url:
+        return None
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "dynamodb":
+        return DynamoDbStore(parsed.netloc)
+    if parsed.scheme == "memory":
+        return MemoryStore()
+    raise ValueError("Unsupported dedup store URL %r" % url)
+
+
+def begin(store: Store, object_id: str) -> Optional[common.Progress]:
+    """
+    Start processing an object.
+
+    Returns None if the object has already been processed, otherwise a
+    Progress which resumes from the last checkpoint and saves new ones.
+    """
+    state = store.get(object_id)
+    if state is not None and state["status"] == DONE:
+        logger.info("Skipping already processed object %s", object_id)
+        return None
+    start_line = state["line"] if state is not None else 0
+    if start_line:
+        logger.info("Resuming %s from line %s", object_id, start_line)
+
+    def save(line: int) -> None:
+        store.put(object_id, {"status": IN_PROGRESS, "line": line})
+
+    return common.Progress(start_line=start_line, on_checkpoint=save)
+
+
+def finish(store: Store, object_id: str) -> None:
+    store.put(object_id, {"status": DONE})
@@ -0,0 +1,148 @@
+import itertools
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+
+import common
+
+DocPredicate = Callable[[common.EsDocument], bool]
+
+
+_DEFAULT_FLAGS = re.compile("").flags
+
+
+def _combinable(pattern: Pattern[str]) -> bool:
+    """
+    Return True if a pattern means the same inside a larger alternation.
+
+    Global inline flags such as "(?i)" would apply to (or, on Python 3.11,
+    reject) the whole combined regex, and capturing groups would renumber any
+    backreferences, so patterns using either are searched on their own.
+    """
+    return pattern.flags == _DEFAULT_FLAGS and pattern.groups == 0
+
+
+def _compile_line_filter(patterns: List[str]) -> Optional[common.LineFilterFn]:
+    """
+    Compile line patterns into a predicate which rejects matching lines.
+
+    Each pattern is validated on its own. Patterns that can be safely combined
+    are joined into one regex so each line is scanned once; the rest are
+    searched in turn.
+    """
+    if not patterns:
+        return None
+    compiled = [re.compile(p) for p in patterns]
+    searches = [p.search for p in compiled if not _combinable(p)]
+    simple = [p.pattern for p in compiled if _combinable(p)]
+    if simple:
+        searches.insert(0, re.compile("|".join("(?:%s)" % p for p in simple)).search)
+    if len(searches) == 1:
+        search = searches[0]
+        return lambda line: search(line) is None
+    return lambda line: not any(search(line) for search in searches)
+
+
+def _compile_match(rule: Dict[str, Any]) -> DocPredicate:
+    """
+    Compile a single field match into a predicate.
+
+    Supported forms:
+        {"field": "x", "equals": value}
+        {"field": "x", "in": [value, ...]}
+        {"field": "x", "min": n, "max": m}  (inclusive, either bound optional)
+    """
+    field = rule["field"]
+    if "equals" in rule:
+        expected = rule["equals"]
+        return lambda doc: field in doc and doc[field] == expected
+    if "in" in rule:
+        choices = frozenset(rule["in"])
+        return lambda doc: doc.get(field) in choices
+    if "min" in rule or "max" in rule:
+        low = rule.get("min", float("-inf"))
+        high = rule.get("max", float("inf"))
+
+        def in_range(doc: common.EsDocument) -> bool:
+            value = doc.get(field)
+            return (
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and low <= value <= high
+            )
+
+        return in_range
+    raise ValueError("Filter rule needs one of equals/in/min/max: %r" % rule)
+
+
+def _compile_sampler(rule: Dict[str, Any]) -> DocPredicate:
+    """Return a predicate which keeps 1 in N matching documents."""
+    keep_one_in = int(rule["keep_one_in"])
+    if keep_one_in < 1:
+        raise ValueError("keep_one_in must be at least 1: %r" % rule)
+    matches = _compile_match(rule)
+    counter = itertools.count()
+    return lambda doc: not matches(doc) or next(counter) % keep_one_in == 0
+
+
+def _compile_doc_filter(
+    drop_rules: List[Dict[str, Any]], sample_rules: List[Dict[str, Any]]
+) -> Optional[common.DocFilterFn]:
+    drops: Tuple[DocPredicate, ...] = tuple(_compile_match(r) for r in drop_rules)
+    samplers: Tuple[DocPredicate, ...] = tuple(
+        _compile_sampler(r) for r in sample_rules
+    )
+    if not drops and not samplers:
+        return None
+
+    def doc_filter(doc: common.EsDocument) -> bool:
+        for drop in drops:
+            if drop(doc):
+                return False
+        for sampler in samplers:
+            if not sampler(doc):
+                return False
+        return True
+
+    return doc_filter
+
+
+def compile_rules(
+    rules: Dict[str, Any],
+) -> Tuple[Optional[common.LineFilterFn], Optional[common.DocFilterFn]]:
+    """
+    Compile a filter specification into line and document predicates.
+
+    Line rules run on the raw log line before the transform function is
+    called, so they are the cheapest place to drop data. Document rules run on
+    the transformed document before it is hashed and sent to Elasticsearch.
+
+    Example specification:
+        {
+            "drop_lines_matching": ["ELB-HealthChecker/"],
+            "drop_docs": [{"field": "aws.cloudtrail.read_only", "equals": true}],
+            "sample_docs": [
+                {"field": "http.response.status_code", "min": 200, "max": 299,
+                 "keep_one_in": 10}
+            ]
+        }
+
+    Either predicate is None if no rules of that kind are configured.
+    """
+    unknown = set(rules) - {"drop_lines_matching", "drop_docs", "sample_docs"}
+    if unknown:
+        raise ValueError("Unknown filter rule types: %s" % ", ".join(sorted(unknown)))
+    line_filter = _compile_line_filter(rules.get("drop_lines_matching", []))
+    doc_filter = _compile_doc_filter(
+        rules.get("drop_docs", []), rules.get("sample_docs", [])
+    )
+    return line_filter, doc_filter
+
+
+def from_json(
+    spec: str,
+) -> Tuple[Optional[common.LineFilterFn], Optional[common.DocFilterFn]]:
+    """Compile filter rules from a JSON string. An empty string disables filtering."""
+    if not spec.strip():
+        return None, None
+    return compile_rules(json.loads(spec))
@@ -1,11 +1,18 @@
 import os
+import json
 import logging
 from typing import Any
 
 from aws_requests_auth.aws_auth import AWSRequestsAuth  # type: ignore
+import botocore.credentials  # type: ignore
 from elasticsearch import Elasticsearch, RequestsHttpConnection  # type: ignore
 
 import common
+import dedup
+import filters
+import profiling
+import sinks
+import spool
 import cloudfront
 import alb
 import cloudtrail
@@ -32,8 +39,38 @@ elif log_type == "cloudtrail":
 else:
     raise ValueError("Unhandled LOG_TYPE '%s'" % log_type)
 
+# Optional filtering and sampling rules, see filters.compile_rules()
+line_filter, doc_filter = filters.from_json(os.environ.get("FILTER_RULES", ""))
 
-def handler(event: Any, _context: Any) -> None:
+# Optional settings for newly created indexes, eg {"refresh_interval": "30s"}
+index_settings = json.loads(os.environ.get("INDEX_SETTINGS", "") or "null")
+
+# Optional spool for documents ES can't accept, eg s3://bucket/prefix
+es_spool = spool.from_url(os.environ.get("SPOOL_URL", ""))
+
+# Optional store of processed objects, eg dynamodb://table
+dedup_store = dedup.from_url(os.environ.get("DEDUP_STORE", ""))
+
+# Optional non-Elasticsearch output, eg null:// or parquet:///tmp/out
+sink = sinks.from_url(os.environ.get("SINK", ""))
+
+# Use the asyncio ingestion engine instead of the default synchronous one.
+# This always writes to Elasticsearch.
+use_async = os.environ.get("ASYNC_INGEST", "") == "1" and sink is None
+if use_async:
+    # Only import aiohttp when it's needed
+    import async_ingest
+
+# Profile a fraction of invocations, eg 0.01. Zero (the default) disables it.
+profile_rate = float(os.environ.get("PROFILE_RATE", "0"))
+
+# Send documents from every object in an invocation through one bulk stream
+coalesce_objects = os.environ.get("COALESCE_OBJECTS", "") == "1"
+
+
+def handler(event: Any, _context: Any) -> None:  # pylint: disable=too-many-branches
+    # Count lines and documents only if this invocation is being profiled
+    transform = profiling.counted(transform_fn)
     # As per https://github.com/DavidMuller/aws-requests-auth#elasticsearch-py-client-usage-example
     auth = AWSRequestsAuth(
         aws_access_key=os.environ["AWS_ACCESS_KEY_ID"],
@@ -50,12 +87,108 @@ def handler(event: Any, _context: Any) -> None:
         connection_class=RequestsHttpConnection,
         http_auth=auth,
     )
+    if event.get("drain_spool"):
+        # Scheduled replay of spooled documents, eg {"drain_spool": true}
+        if es_spool is None:
+            raise ValueError("drain_spool requested but SPOOL_URL is not set")
+        spool.drain(
+            es_spool,
+            es_client,
+            max_segments=event.get("max_segments"),
+            interval=float(event.get("interval", 0)),
+        )
+        return
+    credentials = botocore.credentials.Credentials(
+        os.environ["AWS_ACCESS_KEY_ID"],
+        os.environ["AWS_SECRET_ACCESS_KEY"],
+        os.environ["AWS_SESSION_TOKEN"],
+    )
+    # Objects to send through one shared bulk stream: (bucket, key, dedup id)
+    coalesced = []
     for record in event["Records"]:
         bucket = record["s3"]["bucket"]["name"]
         key = record["s3"]["object"]["key"]
-        if check_filename_fn(key):
-            common.s3_to_es(
-                bucket=bucket, key=key, transform_fn=transform_fn, es_client=es_client
-            )
-        else:
+        if not check_filename_fn(key):
             logger.warning("Skipping object %r", key)
+            continue
+        progress = None
+        object_id = ""
+        if dedup_store is not None:
+            object_id = dedup.object_version_id(
+                bucket,
+                key,
+                record["s3"]["object"].get("eTag", ""),
+                record["s3"]["object"].get("size", 0),
+            )
+            progress = dedup.begin(dedup_store, object_id)
+            if progress is None:
+                continue
+        if coalesce_objects and not use_async:
+            coalesced.append((bucket, key, object_id))
+            continue
+        writer = spool.SpoolWriter(es_spool) if es_spool is not None else None
+        try:
+            if use_async:
+                async_ingest.run(
+                    bucket=bucket,
+                    key=key,
+                    transform_fn=transform,
+                    host=es_host,
+                    region=region,
+                    credentials=credentials,
+                    es_client=es_client,
+                    line_filter=line_filter,
+                    doc_filter=doc_filter,
+                    index_settings=index_settings,
+                    spool_fn=writer.add if writer is not None else None,
+                    start_line=progress.checkpoint if progress is not None else 0,
+                )
+            else:
+                common.s3_to_es(
+                    bucket=bucket,
+                    key=key,
+                    transform_fn=transform,
+                    es_client=es_client,
+                    line_filter=line_filter,
+                    doc_filter=doc_filter,
+                    index_settings=index_settings,
+                    spool_fn=writer.add if writer is not None else None,
+                    progress=progress,
+                    sink=sink,
+                )
+        finally:
+            # Keep whatever was spooled, even if processing failed
+            if writer is not None:
+                writer.flush()
+        if dedup_store is not None:
+            dedup.finish(dedup_store, object_id)
+
+    if coalesced:
+        writer = spool.SpoolWriter(es_spool) if es_spool is not None else None
+        try:
+            common.s3_objects_to_es(
+                objects=[(bucket, key) for bucket, key, _ in coalesced],
+                transform_fn=transform,
+                es_client=es_client,
+                line_filter=line_filter,
+                doc_filter=doc_filter,
+                index_settings=index_settings,
+                spool_fn=writer.add if writer is not None else None,
+                sink=sink,
+            )
+        finally:
+            if writer is not None:
+                writer.flush()
+        if dedup_store is not None:
+            for _, _, object_id in coalesced:
+                dedup.finish(dedup_store, object_id)
+
+
+if profile_rate > 0:
+    handler = profiling.profile_handler(  # type: ignore
+        handler,
+        rate=profile_rate,
+        output=os.environ.get("PROFILE_OUTPUT", "log"),
+        top=int(os.environ.get("PROFILE_TOP", "20")),
+        memory=os.environ.get("PROFILE_MEMORY", "1") == "1",
+    )
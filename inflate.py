@@ -0,0 +1,215 @@
+"""
+Gzip decompression off the main thread.
+
+zlib releases the GIL while inflating, so decompressing on a background
+thread overlaps with parsing on the main thread. Objects made of many small
+concatenated gzip members have their members inflated in parallel.
+"""
+
+import concurrent.futures
+import os
+import queue
+import threading
+import zlib
+from typing import Any, Deque, Iterable, Iterator, List, Optional, TypeVar, Union
+import collections
+
+T = TypeVar("T")
+Buffer = Union[bytes, memoryview]
+
+BLOCK_BYTES = 1024 * 1024  # Bytes fed to, or taken from, zlib at a time
+QUEUE_BLOCKS = 8  # Decompressed blocks buffered between threads
+GZIP_MAGIC = b"\x1f\x8b\x08"  # Gzip header: magic number and deflate method
+# Members are only inflated in parallel if every candidate member is at most
+# MEMBER_BYTES compressed. Each may inflate to at most MEMBER_OUTPUT_BYTES,
+# and at most PENDING_BYTES of inflated members are held ahead of the reader.
+MEMBER_BYTES = 1024 * 1024
+MEMBER_OUTPUT_BYTES = 8 * 1024 * 1024
+PENDING_BYTES = 64 * 1024 * 1024
+_WBITS_GZIP = 16 + zlib.MAX_WBITS
+_TRUNCATED = "Compressed file ended before the end-of-stream marker was reached"
+
+
+def inflate_stream(chunks: Iterable[Buffer]) -> Iterator[bytes]:
+    """
+    Decompress gzip data with any number of members, in order.
+
+    Yields blocks of at most BLOCK_BYTES. Like gzip.GzipFile, raises EOFError
+    if the data ends part way through a member.
+    """
+    d = zlib.decompressobj(_WBITS_GZIP)
+    in_member = False
+    padding = False  # NUL padding is allowed after a member, as in gzip
+    for chunk in chunks:
+        if padding and chunk[:1] == b"\0":
+            chunk = bytes(chunk).lstrip(b"\0")
+        more = bool(chunk)
+        while more:
+            in_member, padding = True, False
+            block = d.decompress(chunk, BLOCK_BYTES)
+            if block:
+                yield block
+            if d.eof:
+                # Start of the next member, if any
+                chunk = d.unused_data.lstrip(b"\0")
+                d = zlib.decompressobj(_WBITS_GZIP)
+                in_member, padding = False, True
+                more = bool(chunk)
+            else:
+                # A full block means zlib may hold more output, even once all
+                # of the input has been consumed
+                chunk = d.unconsumed_tail
+                more = bool(chunk) or len(block) == BLOCK_BYTES
+    if in_member:
+        raise EOFError(_TRUNCATED)
+
+
+def _slices(data: Buffer, size: int = BLOCK_BYTES) -> Iterator[Buffer]:
+    view = memoryview(data)
+    for offset in range(0, len(view), size):
+        yield view[offset : offset + size]
+
+
+def _inflate_member(span: Buffer) -> Optional[bytes]:
+    """
+    Inflate exactly one gzip member, or return None if span isn't one or
+    inflates to more than MEMBER_OUTPUT_BYTES.
+    """
+    d = zlib.decompressobj(_WBITS_GZIP)
+    try:
+        data = d.decompress(span, MEMBER_OUTPUT_BYTES)
+    except zlib.error:
+        return None
+    if not d.eof or d.unused_data.lstrip(b"\0"):
+        return None
+    return data
+
+
+def _member_starts(data: bytes) -> List[int]:
+    """
+    Return candidate member offsets if the data looks like many small
+    members, otherwise an empty list.
+    """
+    starts: List[int] = []
+    offset = data.find(GZIP_MAGIC)
+    if offset != 0:
+        return []
+    while offset != -1:
+        next_offset = data.find(GZIP_MAGIC, offset + 1)
+        end = len(data) if next_offset == -1 else next_offset
+        if end - offset > MEMBER_BYTES:
+            # Big members would hold too much in memory, and a single member
+            # with the magic bytes occurring by chance looks like this too
+            return []
+        starts.append(offset)
+        offset = next_offset
+    return starts if len(starts) > 1 else []
+
+
+def inflate_members(data: bytes, workers: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Decompress in-memory gzip data, inflating small members in parallel.
+
+    Member boundaries can't be known without inflating, so every occurrence
+    of the gzip magic bytes is a candidate boundary. Unless every candidate
+    member is small, the data is simply streamed through inflate_stream. A
+    candidate span is only accepted if it inflates as exactly one complete
+    member. At the first span that doesn't (the magic bytes appeared by
+    chance inside compressed data, or the member inflates to more than
+    MEMBER_OUTPUT_BYTES), the rest of the data is inflated sequentially from
+    the last known good boundary.
+    """
+    starts = _member_starts(data)
+    if not starts:
+        yield from inflate_stream(_slices(data))
+        return
+
+    # Bound the inflated data held by members waiting to be read
+    window = max(1, PENDING_BYTES // MEMBER_OUTPUT_BYTES)
+    workers = min(workers or os.cpu_count() or 2, window)
+    view = memoryview(data)
+    fallback_from: Optional[int] = None
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending: Deque[Any] = collections.deque()
+        for start, end in zip(starts, starts[1:] + [len(data)]):
+            pending.append((start, executor.submit(_inflate_member, view[start:end])))
+            while pending and (len(pending) >= window or end == len(data)):
+                start, future = pending.popleft()
+                block = future.result()
+                if block is None:
+                    fallback_from = start
+                    break
+                for offset in range(0, len(block), BLOCK_BYTES):
+                    yield block[offset : offset + BLOCK_BYTES]
+            if fallback_from is not None:
+                break
+        for _, future in pending:
+            future.cancel()
+    if fallback_from is not None:
+        # Raises EOFError if the data is truncated
+        yield from inflate_stream(_slices(view[fallback_from:]))
+
+
+class _Raise:  # pylint: disable=too-few-public-methods
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+_DONE = object()
+
+
+def background(iterable: Iterable[T], maxsize: int = QUEUE_BLOCKS) -> Iterator[T]:
+    """Run an iterator on a background thread, handing items over a queue."""
+    items: "queue.Queue[Any]" = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run() -> None:
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:  # pylint: disable=broad-except
+            put(_Raise(e))
+        put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Raise):
+                raise item.error
+            yield item
+    finally:
+        # If the consumer stops early, let the producer thread exit
+        stop.set()
+
+
+def split_lines(blocks: Iterable[bytes]) -> Iterator[bytes]:
+    """Split a stream of byte blocks into lines, without the line endings."""
+    # Pieces of a line spanning several blocks. Only each new block is
+    # searched, so very long lines (eg CloudTrail) stay linear.
+    pieces: List[bytes] = []
+    for block in blocks:
+        lines = block.split(b"\n")
+        if len(lines) == 1:
+            pieces.append(block)
+            continue
+        pieces.append(lines[0])
+        yield b"".join(pieces)
+        yield from lines[1:-1]
+        pieces = [lines[-1]]
+    carry = b"".join(pieces)
+    if carry:
+        yield carry
@@ -0,0 +1,153 @@
+"""
+Opt-in profiling of handler invocations.
+
+A sampled fraction of invocations runs under cProfile, and optionally
+tracemalloc, and produces a compact report of the hottest functions and
+allocation sites along with line and document counts. The handler is
+only wrapped when profiling is switched on, so it costs nothing otherwise.
+
+Only the invoking thread is profiled; time spent on background threads (eg
+gzip decompression) shows up as waiting in the main thread.
+"""
+
+import cProfile
+import functools
+import os
+import pstats
+import random
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterable, List
+import logging
+
+import common
+
+logger = logging.getLogger()
+
+# Lines and documents seen by the transform function. Reset per profile.
+COUNTS: Dict[str, int] = {"lines": 0, "documents": 0}
+# True while a sampled invocation is being profiled
+PROFILING = False
+
+Handler = Callable[[Any, Any], None]
+
+
+def count_transform(transform_fn: common.TransformFn) -> common.TransformFn:
+    """Wrap a transform function to count the lines and documents it sees."""
+
+    def counting_transform(line: str, line_no: int) -> Iterable[common.EsDocument]:
+        COUNTS["lines"] += 1
+        for doc in transform_fn(line, line_no):
+            COUNTS["documents"] += 1
+            yield doc
+
+    return counting_transform
+
+
+def counted(transform_fn: common.TransformFn) -> common.TransformFn:
+    """
+    Return transform_fn wrapped to count lines and documents if this
+    invocation is being profiled, otherwise transform_fn itself.
+    """
+    return count_transform(transform_fn) if PROFILING else transform_fn
+
+
+def _cpu_rows(profile: cProfile.Profile, top: int) -> List[str]:
+    stats = pstats.Stats(profile).stats  # type: ignore
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    lines = ["%9s %9s %9s  function" % ("own s", "total s", "calls")]
+    for (filename, line_no, name), (_, calls, own, total, _) in rows:
+        lines.append(
+            "%9.3f %9.3f %9d  %s:%s(%s)"
+            % (own, total, calls, os.path.basename(filename), line_no, name)
+        )
+    return lines
+
+
+def _memory_rows(snapshot: tracemalloc.Snapshot, top: int) -> List[str]:
+    lines = ["%9s %9s  allocation site" % ("KiB", "blocks")]
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append(
+            "%9.1f %9d  %s:%s"
+            % (
+                stat.size / 1024,
+                stat.count,
+                os.path.basename(frame.filename),
+                frame.lineno,
+            )
+        )
+    return lines
+
+
+def report(
+    profile: cProfile.Profile,
+    snapshot: Any,
+    elapsed: float,
+    peak_bytes: int = 0,
+    top: int = 20,
+) -> str:
+    """Format a compact text report of one profiled invocation."""
+    lines = [
+        "Profiled invocation: %.2fs wall, %s lines, %s documents"
+        % (elapsed, COUNTS["lines"], COUNTS["documents"]),
+        "Top functions by own CPU time:",
+    ]
+    lines.extend(_cpu_rows(profile, top))
+    if snapshot is not None:
+        lines.append(
+            "Peak traced memory %.1f MiB. Top allocation sites still live at the end:"
+            % (peak_bytes / 1024 / 1024)
+        )
+        lines.extend(_memory_rows(snapshot, top))
+    return "\n".join(lines)
+
+
+def profile_handler(
+    handler: Handler,
+    rate: float,
+    output: str = "log",
+    top: int = 20,
+    memory: bool = True,
+) -> Handler:
+    """
+    Wrap a Lambda handler so a fraction `rate` of invocations is profiled.
+
+    Reports are logged, or written with the raw pstats data to the
+    directory `output`.
+    """
+
+    @functools.wraps(handler)
+    def profiled(event: Any, context: Any) -> None:
+        global PROFILING  # pylint: disable=global-statement
+        if random.random() >= rate:
+            handler(event, context)
+            return
+        COUNTS["lines"] = COUNTS["documents"] = 0
+        PROFILING = True
+        if memory:
+            tracemalloc.start()
+        profile = cProfile.Profile()
+        start = time.monotonic()
+        try:
+            profile.runcall(handler, event, context)
+        finally:
+            PROFILING = False
+            elapsed = time.monotonic() - start
+            snapshot, peak_bytes = None, 0
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            text = report(profile, snapshot, elapsed, peak_bytes, top)
+            if output == "log":
+                logger.info(text)
+            else:
+                os.makedirs(output, exist_ok=True)
+                name = os.path.join(output, "profile-%d" % (time.time() * 1000))
+                with open(name + ".txt", "w", encoding="utf-8") as f:
+                    f.write(text + "\n")
+                profile.dump_stats(name + ".pstats")
+                logger.info("Wrote profile report to %s.txt", name)
+
+    return profiled
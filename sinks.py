@@ -0,0 +1,150 @@
+"""
+Output sinks for transformed documents.
+
+A sink is any callable which consumes a stream of documents (common.SinkFn).
+Elasticsearch is the default; these sinks let transforms run without a
+cluster, for throughput measurements or cheap compressed archives.
+"""
+
+import gzip
+import os
+import time
+import uuid
+from typing import Any, Dict, IO, Iterable, List, Optional, Union
+import logging
+import urllib.parse
+
+import common
+
+logger = logging.getLogger()
+
+
+# The default sink, defined alongside the code it wraps
+EsSink = common.EsSink
+
+
+class NullSink:  # pylint: disable=too-few-public-methods
+    """Discard documents, logging how fast they were produced."""
+
+    def __call__(self, documents: Iterable[common.EsDocument]) -> None:
+        start = time.monotonic()
+        count = 0
+        for count, _ in enumerate(documents, 1):
+            pass
+        elapsed = time.monotonic() - start
+        logger.info(
+            "Discarded %s documents in %.2fs (%.0f docs/s)",
+            count,
+            elapsed,
+            count / elapsed if elapsed else 0,
+        )
+
+
+class NdjsonSink:  # pylint: disable=too-few-public-methods
+    """
+    Append documents to a file in bulk API format, so it can be replayed
+    into Elasticsearch later. Paths ending in `.gz` are gzipped; each call
+    appends a new gzip member.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def __call__(self, documents: Iterable[common.EsDocument]) -> None:
+        f: Union[gzip.GzipFile, IO[bytes]]
+        if self.path.endswith(".gz"):
+            f = gzip.open(self.path, "ab", compresslevel=6)
+        else:
+            f = open(self.path, "ab")
+        count = 0
+        with f:
+            for count, doc in enumerate(documents, 1):
+                f.write(common._bulk_lines(doc))  # pylint: disable=protected-access
+        logger.info("Wrote %s documents to %s", count, self.path)
+
+
+class ParquetSink:  # pylint: disable=too-few-public-methods
+    """
+    Write documents to Parquet files, one directory per `_index`.
+
+    Each call writes at least one file per index, so without
+    COALESCE_OBJECTS every S3 object gets its own small files.
+
+    Documents are appended straight into per-index column buffers. Fixed
+    schema formats (ALB, CloudFront) fill the same columns every row, while
+    new fields (eg CloudTrail) add a column backfilled with nulls. Columns
+    holding mixed types are written as strings.
+
+    Requires pyarrow, which isn't installed by default.
+    """
+
+    def __init__(self, directory: str, batch_rows: int = 100_000) -> None:
+        # pylint: disable=import-outside-toplevel,import-error
+        import pyarrow  # type: ignore
+        import pyarrow.parquet  # type: ignore
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.directory = directory
+        self.batch_rows = batch_rows
+
+    def _table(self, columns: Dict[str, List[Any]], rows: int) -> Any:
+        arrays = {}
+        for name, values in columns.items():
+            values.extend([None] * (rows - len(values)))
+            try:
+                arrays[name] = self.pa.array(values)
+            except (self.pa.ArrowInvalid, self.pa.ArrowTypeError):
+                arrays[name] = self.pa.array(
+                    [None if v is None else str(v) for v in values]
+                )
+        return self.pa.table(arrays)
+
+    def _flush(self, index: str, columns: Dict[str, List[Any]], rows: int) -> None:
+        directory = os.path.join(self.directory, index)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "%s.parquet" % uuid.uuid4().hex)
+        self.pq.write_table(self._table(columns, rows), path, compression="zstd")
+        logger.info("Wrote %s documents to %s", rows, path)
+
+    def __call__(self, documents: Iterable[common.EsDocument]) -> None:
+        # Per index: column name -> values, and the row count
+        buffers: Dict[str, Dict[str, List[Any]]] = {}
+        rows: Dict[str, int] = {}
+        for doc in documents:
+            index = str(doc.get("_index", "unknown"))
+            columns = buffers.setdefault(index, {})
+            row = rows.get(index, 0)
+            for name, value in doc.items():
+                if name in ("_index", "_type"):
+                    continue
+                column = columns.get(name)
+                if column is None:
+                    column = columns[name] = [None] * row
+                elif len(column) < row:
+                    column.extend([None] * (row - len(column)))
+                column.append(value)
+            rows[index] = row + 1
+            if rows[index] >= self.batch_rows:
+                self._flush(index, buffers.pop(index), rows.pop(index))
+        for index, columns in buffers.items():
+            self._flush(index, columns, rows[index])
+
+
+def from_url(url: str) -> Optional[common.SinkFn]:
+    """
+    Create a sink from a URL like `null://`, `ndjson:///tmp/out.ndjson.gz` or
+    `parquet:///tmp/out`.
+
+    An empty URL means the default Elasticsearch sink, and returns None.
+    """
+    if not url:
+        return None
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "null":
+        return NullSink()
+    if parsed.scheme == "ndjson":
+        return NdjsonSink(parsed.path)
+    if parsed.scheme == "parquet":
+        return ParquetSink(parsed.path)
+    raise ValueError("Unsupported sink URL %r" % url)
@@ -0,0 +1,204 @@
+"""
+Write-ahead spool for documents Elasticsearch couldn't accept.
+
+Documents are stored as gzipped bulk API payloads ("segments") either in a
+local directory or under an S3 prefix. A later drain replays the segments
+into Elasticsearch at a controlled rate.
+"""
+
+import abc
+import gzip
+import itertools
+import os
+import time
+import uuid
+from typing import List, Optional
+import logging
+import urllib.parse
+
+import boto3  # type: ignore
+import elasticsearch  # type: ignore
+
+import common
+
+logger = logging.getLogger()
+
+SEGMENT_SUFFIX = ".ndjson.gz"
+
+
+_SEQUENCE = itertools.count()
+
+
+def _segment_name() -> str:
+    # Sortable by creation time, unique across concurrent Lambda containers
+    return "%013d-%08d-%s%s" % (
+        time.time() * 1000,
+        next(_SEQUENCE),
+        uuid.uuid4().hex,
+        SEGMENT_SUFFIX,
+    )
+
+
+class Spool(abc.ABC):
+    """Storage for compressed bulk payload segments."""
+
+    @abc.abstractmethod
+    def put(self, payload: bytes) -> str:
+        """Store an uncompressed bulk payload. Returns the segment name."""
+
+    @abc.abstractmethod
+    def list(self) -> List[str]:
+        """Return stored segment names, oldest first."""
+
+    @abc.abstractmethod
+    def get(self, name: str) -> bytes:
+        """Return the uncompressed bulk payload of a segment."""
+
+    @abc.abstractmethod
+    def delete(self, name: str) -> None:
+        """Delete a segment once it has been replayed."""
+
+
+class LocalSpool(Spool):
+    """Spool to a local directory. Only survives as long as the container."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, payload: bytes) -> str:
+        name = _segment_name()
+        path = os.path.join(self.directory, name)
+        # Write then rename, so a drain never sees a partial segment
+        with gzip.open(path + ".tmp", "wb") as f:
+            f.write(payload)
+        os.rename(path + ".tmp", path)
+        return name
+
+    def list(self) -> List[str]:
+        return sorted(
+            n for n in os.listdir(self.directory) if n.endswith(SEGMENT_SUFFIX)
+        )
+
+    def get(self, name: str) -> bytes:
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return gzip.decompress(f.read())
+
+    def delete(self, name: str) -> None:
+        os.remove(os.path.join(self.directory, name))
+
+
+class S3Spool(Spool):
+    """Spool to an S3 prefix, so any container can drain it."""
+
+    def __init__(self, bucket: str, prefix: str) -> None:
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/") + "/" if prefix else ""
+        self.s3 = boto3.client("s3")
+
+    def put(self, payload: bytes) -> str:
+        name = _segment_name()
+        self.s3.put_object(
+            Bucket=self.bucket, Key=self.prefix + name, Body=gzip.compress(payload)
+        )
+        return name
+
+    def list(self) -> List[str]:
+        names = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                name = obj["Key"][len(self.prefix) :]
+                if name.endswith(SEGMENT_SUFFIX):
+                    names.append(name)
+        return sorted(names)
+
+    def get(self, name: str) -> bytes:
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        return gzip.decompress(response["Body"].read())
+
+    def delete(self, name: str) -> None:
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+
+def from_url(url: str) -> Optional[Spool]:
+    """
+    Create a spool from a URL like `s3://bucket/prefix` or `file:///tmp/spool`.
+
+    An empty URL disables spooling.
+    """
+    if not url:
+        return None
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "s3":
+        return S3Spool(parsed.netloc, parsed.path.lstrip("/"))
+    if parsed.scheme == "file":
+        return LocalSpool(parsed.path)
+    raise ValueError("Unsupported spool URL %r" % url)
+
+
+class SpoolWriter:
+    """Buffer documents and write them to a spool in size-limited segments."""
+
+    def __init__(self, spool: Spool, segment_bytes: int = 16 * 1024 * 1024) -> None:
+        self.spool = spool
+        self.segment_bytes = segment_bytes
+        self.buffer: List[bytes] = []
+        self.size = 0
+
+    def add(self, doc: common.EsDocument) -> None:
+        data = common._bulk_lines(doc)  # pylint: disable=protected-access
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.segment_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        name = self.spool.put(b"".join(self.buffer))
+        logger.info("Spooled %s documents to segment %s", len(self.buffer), name)
+        self.buffer, self.size = [], 0
+
+
+def drain(
+    spool: Spool,
+    es: elasticsearch.Elasticsearch,
+    max_segments: Optional[int] = None,
+    interval: float = 0,
+) -> int:
+    """
+    Replay spooled segments into Elasticsearch, oldest first.
+
+    Sleeps `interval` seconds between segments to limit the load on the
+    cluster. Stops at the first segment Elasticsearch can't accept, leaving it
+    for the next drain. Returns the number of segments replayed.
+    """
+    replayed = 0
+    for name in spool.list()[:max_segments]:
+        if replayed and interval:
+            time.sleep(interval)
+        try:
+            # elasticsearch-py 6.4 only handles str bulk bodies
+            resp = es.bulk(body=spool.get(name).decode())
+        except elasticsearch.TransportError as e:
+            logger.warning("Couldn't replay segment %s, stopping drain: %s", name, e)
+            break
+        if resp.get("errors"):
+            results = [next(iter(item.values())) for item in resp.get("items", [])]
+            if any(
+                r.get("status")
+                in common._ES_UNAVAILABLE_STATUSES  # pylint: disable=protected-access
+                for r in results
+            ):
+                # Replaying the whole segment again later is safe, as every
+                # document carries its _id
+                logger.warning("Elasticsearch throttled segment %s, stopping", name)
+                break
+            for result in results:
+                if not 200 <= result.get("status", 500) < 300:
+                    logger.warning("Error from Elasticsearch, continuing: %r", result)
+        spool.delete(name)
+        replayed += 1
+    logger.info("Replayed %s spooled segments", replayed)
+    return replayed
@@ -0,0 +1,168 @@
+from typing import Any, Dict, List, Tuple
+import asyncio
+import json
+
+from aiohttp import web
+import boto3  # type: ignore
+import botocore.credentials  # type: ignore
+from moto import mock_s3
+
+import async_ingest
+import common
+
+BUCKET = "mybucket"
+KEY = "mykey"
+
+
+class FakeBulkClient(async_ingest.AsyncBulkClient):
+    """Record bulk bodies and report success."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self) -> None:  # pylint: disable=super-init-not-called
+        self.bodies: List[bytes] = []
+
+    async def bulk(self, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        self.bodies.append(body)
+        return 200, {"errors": False, "items": []}
+
+
+class ScriptedBulkClient(FakeBulkClient):  # pylint: disable=too-few-public-methods
+    """Return each of `responses` in turn."""
+
+    def __init__(self, responses: List[Tuple[int, Dict[str, Any]]]) -> None:
+        super().__init__()
+        self.responses = responses
+
+    async def bulk(self, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        self.bodies.append(body)
+        return self.responses.pop(0)
+
+
+async def no_sleep(_seconds: float) -> None:
+    pass
+
+
+def test_chunk_documents() -> None:
+    docs: List[common.EsDocument] = [
+        {"_index": "i", "_id": str(n), "n": n} for n in range(5)
+    ]
+    chunk_documents = async_ingest._chunk_documents  # pylint: disable=protected-access
+    chunks = list(chunk_documents(docs, chunk_size=2))
+    assert [len(c[1]) for c in chunks] == [2, 2, 1]
+    lines = chunks[0][0].decode().splitlines()
+    assert json.loads(lines[0]) == {"index": {"_index": "i", "_id": "0"}}
+    assert json.loads(lines[1]) == {"n": 0}
+
+
+def test_chunk_documents_bytes_limit() -> None:
+    docs: List[common.EsDocument] = [{"_index": "i", "_id": str(n)} for n in range(3)]
+    chunk_documents = async_ingest._chunk_documents  # pylint: disable=protected-access
+    chunks = list(chunk_documents(docs, max_chunk_bytes=1))
+    # Oversized documents are still sent, one per chunk
+    assert [len(c[1]) for c in chunks] == [1, 1, 1]
+
+
+def test_report_errors() -> None:
+    docs: List[Dict[str, Any]] = [{"_id": "a"}, {"_id": "b"}]
+    resp = {
+        "errors": True,
+        "items": [{"index": {"status": 201}}, {"index": {"status": 400}}],
+    }
+    report_errors = async_ingest._report_errors  # pylint: disable=protected-access
+    assert report_errors(resp, docs) == 1
+    assert report_errors({"errors": False}, docs) == 0
+
+
+def test_send_chunk_retries_throttled_items(monkeypatch: Any) -> None:
+    monkeypatch.setattr(asyncio, "sleep", no_sleep)
+    docs: List[common.EsDocument] = [{"_index": "i", "_id": c} for c in "abc"]
+    client = ScriptedBulkClient(
+        [
+            (
+                200,
+                {
+                    "errors": True,
+                    "items": [
+                        {"index": {"status": 201}},
+                        {"index": {"status": 429}},
+                        {"index": {"status": 400}},
+                    ],
+                },
+            ),
+            (200, {"errors": False, "items": [{"index": {"status": 201}}]}),
+        ]
+    )
+    chunk_documents = async_ingest._chunk_documents  # pylint: disable=protected-access
+    send_chunk = async_ingest._send_chunk  # pylint: disable=protected-access
+    assert asyncio.run(send_chunk(client, next(chunk_documents(docs)))) == 2
+    # Only the throttled document was sent again
+    assert b'"_id":"b"' in client.bodies[1]
+    assert len(client.bodies[1].splitlines()) == 2
+
+
+def test_sender_diverts_when_unavailable() -> None:
+    docs: List[common.EsDocument] = [{"_index": "i", "_id": str(n)} for n in range(3)]
+    client = ScriptedBulkClient([(503, {"error": "unavailable"})])
+    spooled: List[common.EsDocument] = []
+    diverter = async_ingest._Diverter(  # pylint: disable=protected-access
+        spooled.append
+    )
+    chunk_documents = async_ingest._chunk_documents  # pylint: disable=protected-access
+    sender = async_ingest._sender  # pylint: disable=protected-access
+
+    async def main() -> int:
+        queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        for chunk in chunk_documents(docs, chunk_size=1):
+            queue.put_nowait(chunk)
+        queue.put_nowait(None)
+        return await sender(client, queue, diverter)
+
+    assert asyncio.run(main()) == 0
+    # Only the first chunk was sent, the rest went straight to the spool
+    assert len(client.bodies) == 1
+    assert spooled == docs
+
+
+def test_bulk_non_json_error() -> None:
+    async def bad_gateway(_request: web.Request) -> web.Response:
+        return web.Response(status=502, text="<html>Bad Gateway</html>")
+
+    async def main() -> Tuple[int, Dict[str, Any]]:
+        app = web.Application()
+        app.router.add_post("/_bulk", bad_gateway)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        server = site._server  # pylint: disable=protected-access
+        port = server.sockets[0].getsockname()[1]  # type: ignore
+        credentials = botocore.credentials.Credentials("key", "secret")
+        try:
+            async with async_ingest.AsyncBulkClient(
+                "127.0.0.1", "us-east-1", credentials
+            ) as client:
+                client.url = "http://127.0.0.1:%s/_bulk" % port
+                return await client.bulk(b"{}\n")
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(main()) == (502, {"error": "<html>Bad Gateway</html>"})
+
+
+@mock_s3  # type: ignore
+def test_s3_to_es() -> None:
+    conn = boto3.client("s3")
+    conn.create_bucket(Bucket=BUCKET)
+    conn.put_object(Bucket=BUCKET, Key=KEY, Body=b"a\nb\nc\n")
+    client = FakeBulkClient()
+    transform_fn = lambda line, _n: [{"_index": "i", "line": line}]
+
+    asyncio.run(async_ingest.s3_to_es(BUCKET, KEY, transform_fn, client))
+
+    sent = [json.loads(l) for body in client.bodies for l in body.splitlines()]
+    assert [doc for doc in sent if "line" in doc] == [
+        {"line": "a"},
+        {"line": "b"},
+        {"line": "c"},
+    ]
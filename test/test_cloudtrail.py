@@ -1,5 +1,7 @@
 import json
 
+import pytest
+
 import cloudtrail
 
 EXAMPLE = """{"Records":[{
@@ -123,3 +125,72 @@ def test_s3_key_names() -> None:
     assert not cloudtrail.check_filename(
         "prefix/AWSLogs/0123/0123/CloudTrail-Digest/region/digest-end-year/digest-end-month/digest-end-date/aws-account-id_CloudTrail-Digest_region_trail-name_region_digest_end_timestamp.json.gz"
     )
+
+
+def test_transform_collapse_deep(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(
+        cloudtrail, "SECTION_FIELDS", {"requestParameters.a.b.c.d_json"}
+    )
+    obj = {
+        "Records": [
+            {
+                "eventTime": "2019-09-09T00:00:01Z",
+                "eventSource": "deep.amazonaws.com",
+                "requestParameters": {"a": {"b": {"c": {"d": {"e": 1}}}}},
+            }
+        ]
+    }
+    (doc,) = cloudtrail.transform(json.dumps(obj), 0)
+    assert doc["aws.cloudtrail.request_parameters.a.b.c.d_json"] == '{"e": 1}'
+    assert doc["aws.cloudtrail.collapsed_fields"] == "request_parameters.a.b.c.d"
+    assert not any(k.endswith(".e") for k in doc)
+
+
+def test_transform_collapse_wide(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(
+        cloudtrail,
+        "SECTION_FIELDS",
+        {"requestParameters.tags_json", "requestParameters.items.1"},
+    )
+    tags = {"tag%s" % n: "v" for n in range(cloudtrail.MAX_CHILDREN + 1)}
+    obj = {
+        "Records": [
+            {
+                "eventTime": "2019-09-09T00:00:01Z",
+                "eventSource": "wide.amazonaws.com",
+                "requestParameters": {"tags": tags, "items": [1, 2]},
+            }
+        ]
+    }
+    (doc,) = cloudtrail.transform(json.dumps(obj), 0)
+    assert json.loads(str(doc["aws.cloudtrail.request_parameters.tags_json"])) == tags
+    # Short lists are still enumerated
+    assert doc["aws.cloudtrail.request_parameters.items.1"] == 2
+
+
+def test_field_allowlist() -> None:
+    fields, collapsed = cloudtrail.budget_section(
+        "s3.amazonaws.com",
+        "requestParameters",
+        {"bucketName": "b", "other": 1, "deep": {"a": {"b": {"c": {"d": 1}}}}},
+    )
+    # Allowlisted fields are kept, others go into one overflow field
+    assert fields == {
+        "requestParameters.bucketName": "b",
+        "requestParameters_overflow": json.dumps(
+            {
+                "requestParameters.deep.a.b.c_json": '{"d": 1}',
+                "requestParameters.other": 1,
+            },
+            sort_keys=True,
+        ),
+    }
+    assert collapsed == ["requestParameters.deep.a.b.c", "requestParameters.other"]
+    # Any eventSource gets the same fields, as they share an index
+    assert cloudtrail.budget_section(
+        "other.amazonaws.com", "requestParameters", {"bucketName": "b"}
+    ) == ({"requestParameters.bucketName": "b"}, [])
+    assert (
+        len(cloudtrail.SECTION_FIELDS) + len(cloudtrail.BUDGETED_SECTIONS)
+        <= cloudtrail.MAX_SECTION_FIELDS_PER_INDEX
+    )
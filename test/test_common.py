@@ -1,9 +1,11 @@
-from typing import Dict, Callable, Iterable, Union
+from typing import Any, Dict, Callable, Iterable, List, Optional, Union
 import gzip
+import logging
 
 import boto3  # type: ignore
-from moto import mock_s3  # type: ignore
-import pytest  # type: ignore
+import elasticsearch  # type: ignore
+from moto import mock_s3
+import pytest
 
 import common
 
@@ -85,3 +87,164 @@ def test_buffering_iterator() -> None:
         {},
         {"_id": "abc"},
     ]
+
+
+def test_group_by_index() -> None:
+    docs: List[common.EsDocument] = [
+        {"_index": "a", "n": 1},
+        {"_index": "b", "n": 2},
+        {"_index": "a", "n": 3},
+        {"_index": "a", "_routing": "r", "n": 4},
+        {"_index": "b", "n": 5},
+    ]
+    group_by_index = common._group_by_index  # pylint: disable=protected-access
+    assert [d["n"] for d in group_by_index(docs)] == [1, 3, 2, 5, 4]
+    # Grouping only happens within each window
+    assert [d["n"] for d in group_by_index(docs, window=2)] == [1, 2, 3, 4, 5]
+
+
+class FakeIndices:  # pylint: disable=too-few-public-methods
+    """Record index creation, failing for indexes in `errors`."""
+
+    def __init__(self, errors: Optional[Dict[str, str]] = None) -> None:
+        self.created: List[str] = []
+        self.errors = errors or {}
+
+    def create(self, index: str, **_kwargs: Any) -> None:
+        self.created.append(index)
+        if index in self.errors:
+            raise elasticsearch.RequestError(400, self.errors[index], {})
+
+
+class FakeEs:  # pylint: disable=too-few-public-methods
+    """Elasticsearch client with only an indices API."""
+
+    def __init__(self, errors: Optional[Dict[str, str]] = None) -> None:
+        self.indices = FakeIndices(errors)
+
+
+def test_ensure_indexes() -> None:
+    es = FakeEs()
+    docs: List[common.EsDocument] = [
+        {"_index": "ensure-a"},
+        {"_index": "ensure-b"},
+        {"_index": "ensure-a"},
+    ]
+    ensure_indexes = common._ensure_indexes  # pylint: disable=protected-access
+    assert list(ensure_indexes(es, docs, {"refresh_interval": "30s"})) == docs
+    assert es.indices.created == ["ensure-a", "ensure-b"]
+    # Indexes are only created once per container
+    list(ensure_indexes(es, docs, {"refresh_interval": "30s"}))
+    assert es.indices.created == ["ensure-a", "ensure-b"]
+
+
+def test_ensure_indexes_errors() -> None:
+    es = FakeEs(
+        {
+            "exists": "resource_already_exists_exception",
+            "invalid": "illegal_argument_exception",
+        }
+    )
+    docs: List[common.EsDocument] = [
+        {"_index": "exists"},
+        {"_index": "invalid"},
+        {"_index": "invalid"},
+    ]
+    ensure_indexes = common._ensure_indexes  # pylint: disable=protected-access
+    assert list(ensure_indexes(es, docs, {"bad": "setting"})) == docs
+    assert es.indices.created == ["exists", "invalid"]
+    # Existing indexes count as created, failures are tried again next time
+    list(ensure_indexes(es, docs, {"bad": "setting"}))
+    assert es.indices.created == ["exists", "invalid", "invalid"]
+
+
+def test_stream_to_es_spools_when_unavailable() -> None:
+    # Nothing listens on port 1, so every bulk request fails to connect
+    es = elasticsearch.Elasticsearch(hosts=["localhost:1"], max_retries=0)
+    docs: List[common.EsDocument] = [
+        {"_index": "i", "_type": "doc", "_id": str(n)} for n in range(3)
+    ]
+    spooled: List[Dict[str, Any]] = []
+    stream_to_es = common._stream_to_es  # pylint: disable=protected-access
+    stream_to_es(es, docs, spooled.append)
+    assert spooled == docs
+
+
+def test_stream_to_es_reports_diverted(monkeypatch: pytest.MonkeyPatch) -> None:
+    # After the first chunk fails the rest are spooled without being sent,
+    # but every document still gets a result
+    monkeypatch.setitem(common._ES_STREAM_BULK_OPTS, "chunk_size", 1)
+    es = elasticsearch.Elasticsearch(hosts=["localhost:1"], max_retries=0)
+    docs: List[common.EsDocument] = [
+        {"_index": "i", "_type": "doc", "_id": str(n)} for n in range(3)
+    ]
+    spooled: List[Dict[str, Any]] = []
+    results: List[Any] = []
+    stream_to_es = common._stream_to_es  # pylint: disable=protected-access
+    stream_to_es(es, docs, spooled.append, result_fn=lambda *r: results.append(r))
+    assert sorted(d["_id"] for d in spooled) == ["0", "1", "2"]
+    assert sorted(results) == [(False, "0"), (False, "1"), (False, "2")]
+
+
+def test_progress() -> None:
+    saved: List[int] = []
+    progress = common.Progress(start_line=1, on_checkpoint=saved.append, interval=0)
+    lines = progress.track_lines(["header", "a", "b", "c"])
+    docs = common._transform_lines(  # pylint: disable=protected-access
+        lines, lambda line, _n: [{"l": line}, {"l": line}], start_line=1
+    )
+    emitted = list(progress.track_documents(docs))
+    assert [d["l"] for d in emitted] == ["a", "a", "b", "b", "c", "c"]
+    progress.acknowledge(2)
+    assert progress.checkpoint == 1  # Line 1 ("a") might not be finished yet
+    progress.acknowledge(4)
+    assert progress.checkpoint == 2
+    assert saved == [1, 2]
+
+
+@mock_s3  # type: ignore
+def test_s3_objects_to_es(caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.INFO)
+    conn = boto3.client("s3")
+    conn.create_bucket(Bucket=BUCKET)
+    conn.put_object(Bucket=BUCKET, Key=KEY_RAW, Body=BODY_RAW)
+    conn.put_object(Bucket=BUCKET, Key=KEY_GZIP, Body=BODY_GZIP)
+    # Nothing listens on port 1, so every document ends up in the spool
+    es = elasticsearch.Elasticsearch(hosts=["localhost:1"], max_retries=0)
+    spooled: List[Dict[str, Any]] = []
+    common.s3_objects_to_es(
+        [(BUCKET, KEY_RAW), (BUCKET, KEY_GZIP)],
+        lambda line, _n: [{"_index": "i", "_type": "doc", "line": line}],
+        es,
+        spool_fn=spooled.append,
+    )
+    # Documents from both objects go through one stream; identical lines in
+    # both objects produce identical documents
+    assert sorted(d["line"] for d in spooled) == ["a", "a", "b", "b", "c", "c"]
+    # Each copy is attributed to its own object, including documents spooled
+    # without being sent
+    for key in (KEY_RAW, KEY_GZIP):
+        assert (
+            "s3://%s/%s: 3 documents, 3 failed or spooled" % (BUCKET, key)
+            in caplog.text
+        )
+
+
+@mock_s3  # type: ignore
+def test_s3_to_es_sink() -> None:
+    conn = boto3.client("s3")
+    conn.create_bucket(Bucket=BUCKET)
+    conn.put_object(Bucket=BUCKET, Key=KEY_RAW, Body=BODY_RAW)
+    written: List[Dict[str, Any]] = []
+    es = FakeEs()
+    common.s3_to_es(
+        BUCKET,
+        KEY_RAW,
+        lambda line, _n: [{"_index": "i", "line": line}],
+        es,
+        index_settings={"refresh_interval": "30s"},
+        sink=written.extend,
+    )
+    assert [d["line"] for d in written] == ["a", "b", "c"]
+    # Indexes are only created for Elasticsearch output
+    assert es.indices.created == []
@@ -0,0 +1,47 @@
+import boto3  # type: ignore
+import pytest
+from moto import mock_dynamodb
+
+import dedup
+
+TABLE = "dedup"
+
+
+def test_object_version_id() -> None:
+    assert dedup.object_version_id("b", "k", "abc", 12) == "b/k@abc:12"
+
+
+def test_begin_finish() -> None:
+    store = dedup.MemoryStore()
+    progress = dedup.begin(store, "obj")
+    assert progress is not None and progress.checkpoint == 0
+    dedup.finish(store, "obj")
+    assert dedup.begin(store, "obj") is None
+
+
+def test_resume() -> None:
+    store = dedup.MemoryStore()
+    store.put("obj", {"status": dedup.IN_PROGRESS, "line": 42})
+    progress = dedup.begin(store, "obj")
+    assert progress is not None and progress.checkpoint == 42
+
+
+def test_from_url() -> None:
+    assert dedup.from_url("") is None
+    assert isinstance(dedup.from_url("memory://"), dedup.MemoryStore)
+
+
+@mock_dynamodb  # type: ignore
+def test_dynamodb_store(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    boto3.client("dynamodb").create_table(
+        TableName=TABLE,
+        KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    store = dedup.from_url("dynamodb://%s" % TABLE)
+    assert store is not None
+    assert store.get("obj") is None
+    store.put("obj", {"status": dedup.IN_PROGRESS, "line": 7})
+    assert store.get("obj") == {"status": dedup.IN_PROGRESS, "line": 7}
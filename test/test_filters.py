@@ -0,0 +1,98 @@
+import re
+
+import pytest
+
+import common
+import filters
+
+
+def test_no_rules() -> None:
+    assert filters.from_json("") == (None, None)
+    assert filters.compile_rules({}) == (None, None)
+
+
+def test_unknown_rule() -> None:
+    with pytest.raises(ValueError):
+        filters.compile_rules({"drop_everything": True})
+
+
+def test_drop_lines() -> None:
+    line_filter, doc_filter = filters.compile_rules(
+        {"drop_lines_matching": ["ELB-HealthChecker/", "^#"]}
+    )
+    assert line_filter is not None and doc_filter is None
+    assert not line_filter('http ... "ELB-HealthChecker/2.0" ...')
+    assert not line_filter("#Version: 1.0")
+    assert line_filter('http ... "curl/7.46.0" ...')
+
+
+def test_drop_lines_uncombinable() -> None:
+    line_filter, _ = filters.compile_rules(
+        {"drop_lines_matching": ["^DEBUG", "(?i)healthcheck", r"(\w)\1{3}"]}
+    )
+    assert line_filter is not None
+    assert not line_filter("DEBUG start")
+    assert not line_filter("GET /HealthCheck")
+    assert not line_filter("id=aaaa")
+    # The inline flag must not leak into the other patterns
+    assert line_filter("debug start")
+    assert line_filter("id=abab")
+
+
+def test_drop_lines_invalid() -> None:
+    with pytest.raises(re.error):
+        filters.compile_rules({"drop_lines_matching": ["ok", "("]})
+
+
+def test_drop_docs() -> None:
+    _, doc_filter = filters.compile_rules(
+        {
+            "drop_docs": [
+                {"field": "aws.cloudtrail.read_only", "equals": True},
+                {"field": "http.request.method", "in": ["OPTIONS", "HEAD"]},
+            ]
+        }
+    )
+    assert doc_filter is not None
+    assert not doc_filter({"aws.cloudtrail.read_only": True})
+    assert doc_filter({"aws.cloudtrail.read_only": False})
+    assert not doc_filter({"http.request.method": "HEAD"})
+    assert doc_filter({"http.request.method": "GET"})
+    assert doc_filter({})
+
+
+def test_sample_docs() -> None:
+    _, doc_filter = filters.compile_rules(
+        {
+            "sample_docs": [
+                {
+                    "field": "http.response.status_code",
+                    "min": 200,
+                    "max": 299,
+                    "keep_one_in": 10,
+                }
+            ]
+        }
+    )
+    assert doc_filter is not None
+    ok = [doc_filter({"http.response.status_code": 200}) for _ in range(100)]
+    assert ok.count(True) == 10
+    errors = [doc_filter({"http.response.status_code": 503}) for _ in range(100)]
+    assert all(errors)
+
+
+def test_transform_lines_filters() -> None:
+    lines = ["skip", "a", "b", "c"]
+    transform_fn = lambda line, n: [{"_id": line, "n": n}]
+    transform_lines = common._transform_lines  # pylint: disable=protected-access
+    line_filter, doc_filter = filters.compile_rules(
+        {
+            "drop_lines_matching": ["^skip$"],
+            "drop_docs": [{"field": "_id", "equals": "b"}],
+        }
+    )
+    # Line numbers are preserved for transform_fn even when lines are skipped
+    assert list(transform_lines(lines, transform_fn, line_filter, doc_filter)) == [
+        {"_id": "a", "n": 1},
+        {"_id": "c", "n": 3},
+    ]
@@ -0,0 +1,115 @@
+import gzip
+import random
+from typing import Any, Iterator
+
+import pytest
+
+import inflate
+
+LINES = [b"line %d %s" % (n, b"x" * (n % 50)) for n in range(20_000)]
+BODY = b"\n".join(LINES) + b"\n"
+
+
+def members(count: int, compresslevel: int = 9) -> bytes:
+    """Split BODY into `count` concatenated gzip members."""
+    step = len(BODY) // count + 1
+    return b"".join(
+        gzip.compress(BODY[i : i + step], compresslevel)
+        for i in range(0, len(BODY), step)
+    )
+
+
+def test_inflate_stream_multi_member() -> None:
+    data = members(5)
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    assert b"".join(inflate.inflate_stream(chunks)) == BODY
+
+
+def test_inflate_members() -> None:
+    for count in (1, 2, 17):
+        assert b"".join(inflate.inflate_members(members(count), workers=2)) == BODY
+
+
+def test_inflate_members_false_boundary() -> None:
+    # Uncompressed gzip members contain their input verbatim, so a payload
+    # containing the gzip magic bytes creates a false member boundary
+    payload = b"before " + inflate.GZIP_MAGIC + b" after\n"
+    data = gzip.compress(BODY) + gzip.compress(payload, 0) + gzip.compress(BODY)
+    assert b"".join(inflate.inflate_members(data, workers=2)) == (BODY + payload + BODY)
+
+
+def test_inflate_members_bad_data() -> None:
+    with pytest.raises(Exception):
+        list(inflate.inflate_members(b"not gzip data"))
+
+
+def test_background() -> None:
+    assert list(inflate.background(iter(range(100)), maxsize=2)) == list(range(100))
+
+
+def test_background_error() -> None:
+    def failing() -> Iterator[int]:
+        yield 1
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        list(inflate.background(failing()))
+
+
+def test_split_lines() -> None:
+    blocks = [b"a\nb", b"c\n", b"\nd"]
+    assert list(inflate.split_lines(blocks)) == [b"a", b"bc", b"", b"d"]
+    random.seed(1)
+    cuts = sorted(random.sample(range(len(BODY)), 100))
+    blocks = [BODY[i:j] for i, j in zip([0] + cuts, cuts + [len(BODY)])]
+    assert list(inflate.split_lines(blocks)) == LINES
+
+
+def test_inflate_truncated() -> None:
+    data = members(1)
+    with pytest.raises(EOFError):
+        list(inflate.inflate_stream([data[: len(data) // 2]]))
+    with pytest.raises(EOFError):
+        list(inflate.inflate_members(data[: len(data) // 2]))
+    data = members(5)
+    with pytest.raises(EOFError):
+        list(inflate.inflate_members(data[:-10], workers=2))
+
+
+def test_inflate_bounded_blocks(monkeypatch: Any) -> None:
+    monkeypatch.setattr(inflate, "BLOCK_BYTES", 1000)
+    monkeypatch.setattr(inflate, "MEMBER_OUTPUT_BYTES", 10_000)
+    blocks = list(inflate.inflate_stream([gzip.compress(BODY)]))
+    assert max(len(b) for b in blocks) == 1000
+    assert b"".join(blocks) == BODY
+    # Members inflating to more than MEMBER_OUTPUT_BYTES are streamed instead
+    blocks = list(inflate.inflate_members(members(4), workers=2))
+    assert max(len(b) for b in blocks) == 1000
+    assert b"".join(blocks) == BODY
+
+
+def test_inflate_members_big_spans_stream(monkeypatch: Any) -> None:
+    # A false boundary in a big single member must not be inflated twice
+    monkeypatch.setattr(inflate, "MEMBER_BYTES", 100)
+    data = gzip.compress(BODY + inflate.GZIP_MAGIC + BODY, 0)
+    assert inflate._member_starts(data) == []  # pylint: disable=protected-access
+    assert b"".join(inflate.inflate_members(data)) == BODY + inflate.GZIP_MAGIC + BODY
+
+
+def test_split_lines_long_line() -> None:
+    line = b"x" * 1000
+    blocks = [line[i : i + 10] for i in range(0, len(line), 10)]
+    assert list(inflate.split_lines(blocks + [b"\nnext"])) == [line, b"next"]
+    assert list(inflate.split_lines(blocks)) == [line]
+
+
+def test_inflate_nul_padding() -> None:
+    # gzip.GzipFile accepts NUL padding after members
+    padded = gzip.compress(BODY) + b"\0" * 16
+    data = padded + gzip.compress(BODY) + b"\0" * 16
+    assert b"".join(inflate.inflate_stream([data])) == BODY + BODY
+    chunks = [data[: len(padded) - 8], data[len(padded) - 8 : len(padded)]]
+    chunks.append(data[len(padded) :])
+    assert b"".join(inflate.inflate_stream(chunks)) == BODY + BODY
+    assert b"".join(inflate.inflate_members(data, workers=2)) == BODY + BODY
+    assert b"".join(inflate.inflate_members(padded)) == BODY
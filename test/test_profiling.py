@@ -0,0 +1,50 @@
+from typing import Any, List
+import logging
+import pathlib
+
+import pytest
+
+import profiling
+
+
+def transform(line: str, _line_no: int) -> List[Any]:
+    return [{"line": line}, {"line": line}]
+
+
+def make_handler() -> profiling.Handler:
+    def handler(event: Any, _context: Any) -> None:
+        counted = profiling.counted(transform)
+        for n, line in enumerate(event["lines"]):
+            list(counted(line, n))
+
+    return handler
+
+
+def test_profile_to_log(caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.INFO)
+    handler = profiling.profile_handler(make_handler(), rate=1, top=5)
+    handler({"lines": ["a", "b", "c"]}, None)
+    (text,) = [r.getMessage() for r in caplog.records]
+    assert "3 lines, 6 documents" in text
+    assert "test_profiling.py" in text
+    assert "allocation site" in text
+
+
+def test_profile_to_file(tmp_path: pathlib.Path) -> None:
+    handler = profiling.profile_handler(
+        make_handler(), rate=1, output=str(tmp_path), memory=False
+    )
+    handler({"lines": ["a"]}, None)
+    names = sorted(p.suffix for p in tmp_path.iterdir())
+    assert names == [".pstats", ".txt"]
+
+
+def test_profile_not_sampled(caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.INFO)
+    handler = profiling.profile_handler(make_handler(), rate=0)
+    profiling.COUNTS["lines"] = 0
+    handler({"lines": ["a"]}, None)
+    assert not caplog.records
+    # Unsampled invocations don't count
+    assert profiling.COUNTS["lines"] == 0
+    assert profiling.counted(transform) is transform
@@ -0,0 +1,55 @@
+import gzip
+import json
+import logging
+import pathlib
+from typing import List
+
+import pytest
+
+import common
+import sinks
+
+DOCS: List[common.EsDocument] = [
+    {"_index": "alb-2019-01-01", "_type": "doc", "_id": "a", "status": 200},
+    {"_index": "alb-2019-01-02", "_type": "doc", "_id": "b", "status": 500},
+    {"_index": "alb-2019-01-01", "_type": "doc", "_id": "c", "extra": "x"},
+]
+
+
+def test_from_url() -> None:
+    assert sinks.from_url("") is None
+    assert isinstance(sinks.from_url("null://"), sinks.NullSink)
+    with pytest.raises(ValueError):
+        sinks.from_url("ftp://host/path")
+
+
+def test_null_sink(caplog: pytest.LogCaptureFixture) -> None:
+    caplog.set_level(logging.INFO)
+    sinks.NullSink()(iter(DOCS))
+    assert "Discarded 3 documents" in caplog.text
+
+
+def test_ndjson_sink(tmp_path: pathlib.Path) -> None:
+    path = str(tmp_path / "out.ndjson.gz")
+    sink = sinks.NdjsonSink(path)
+    sink(DOCS)
+    sink(DOCS[:1])  # Appends a second gzip member
+    with gzip.open(path) as f:
+        lines = [json.loads(l) for l in f]
+    assert len(lines) == 8
+    assert lines[0] == {
+        "index": {"_index": "alb-2019-01-01", "_type": "doc", "_id": "a"}
+    }
+    assert lines[1] == {"status": 200}
+
+
+def test_parquet_sink(tmp_path: pathlib.Path) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    sinks.ParquetSink(str(tmp_path))(DOCS)
+    (first,) = (tmp_path / "alb-2019-01-01").iterdir()
+    assert pq.read_table(first).to_pydict() == {
+        "_id": ["a", "c"],
+        "status": [200, None],
+        "extra": [None, "x"],
+    }
+    assert len(list((tmp_path / "alb-2019-01-02").iterdir())) == 1
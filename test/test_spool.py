@@ -0,0 +1,124 @@
+from typing import Any, Dict, List
+import json
+import pathlib
+
+import boto3  # type: ignore
+import elasticsearch  # type: ignore
+from moto import mock_s3
+
+import spool
+
+BUCKET = "spoolbucket"
+
+
+class RecordingTransport(elasticsearch.Transport):  # type: ignore
+    """Transport which records requests instead of sending them."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.requests: List[Any] = []
+
+    def perform_request(  # pylint: disable=too-many-arguments
+        self,
+        method: str,
+        url: str,
+        headers: Any = None,
+        params: Any = None,
+        body: Any = None,
+    ) -> Any:
+        self.requests.append((method, url, body))
+        return {"errors": False, "items": [{"index": {"status": 201}}]}
+
+
+class FakeEs:  # pylint: disable=too-few-public-methods
+    """Bulk API which succeeds with `status` or fails to connect."""
+
+    def __init__(self, fail: bool = False, status: int = 201) -> None:
+        self.fail = fail
+        self.status = status
+        self.bodies: List[str] = []
+
+    def bulk(self, body: str) -> Dict[str, Any]:
+        if self.fail:
+            raise elasticsearch.ConnectionError("N/A", "down", None)
+        self.bodies.append(body)
+        return {
+            "errors": self.status >= 300,
+            "items": [{"index": {"status": self.status}}],
+        }
+
+
+def test_local_spool(tmp_path: pathlib.Path) -> None:
+    local = spool.LocalSpool(str(tmp_path))
+    first = local.put(b"one")
+    second = local.put(b"two")
+    assert local.list() == sorted([first, second])
+    assert local.get(first) == b"one"
+    local.delete(first)
+    assert local.list() == [second]
+
+
+@mock_s3  # type: ignore
+def test_s3_spool() -> None:
+    boto3.client("s3").create_bucket(Bucket=BUCKET)
+    s3 = spool.from_url("s3://%s/spool" % BUCKET)
+    assert isinstance(s3, spool.S3Spool)
+    name = s3.put(b"payload")
+    assert s3.list() == [name]
+    assert s3.get(name) == b"payload"
+    s3.delete(name)
+    assert s3.list() == []
+
+
+def test_from_url(tmp_path: pathlib.Path) -> None:
+    assert spool.from_url("") is None
+    assert isinstance(spool.from_url("file://%s" % tmp_path), spool.LocalSpool)
+
+
+def test_spool_writer(tmp_path: pathlib.Path) -> None:
+    local = spool.LocalSpool(str(tmp_path))
+    writer = spool.SpoolWriter(local)
+    writer.add({"_index": "i", "_id": "a", "x": 1})
+    writer.add({"_index": "i", "_id": "b", "x": 2})
+    assert local.list() == []
+    writer.flush()
+    (name,) = local.list()
+    lines = [json.loads(l) for l in local.get(name).splitlines()]
+    assert lines == [
+        {"index": {"_index": "i", "_id": "a"}},
+        {"x": 1},
+        {"index": {"_index": "i", "_id": "b"}},
+        {"x": 2},
+    ]
+
+
+def test_drain(tmp_path: pathlib.Path) -> None:
+    local = spool.LocalSpool(str(tmp_path))
+    local.put(b"one")
+    local.put(b"two")
+    local.put(b"three")
+    es = FakeEs()
+    assert spool.drain(local, es, max_segments=2) == 2
+    assert es.bodies == ["one", "two"]
+    assert len(local.list()) == 1
+
+
+def test_drain_real_client(tmp_path: pathlib.Path) -> None:
+    # Goes through the client's own bulk body handling
+    local = spool.LocalSpool(str(tmp_path))
+    payload = b'{"index":{"_index":"i","_id":"a"}}\n{"x":1}\n'
+    local.put(payload)
+    es = elasticsearch.Elasticsearch(transport_class=RecordingTransport)
+    assert spool.drain(local, es) == 1
+    assert es.transport.requests == [("POST", "/_bulk", payload.decode())]
+
+
+def test_drain_unavailable(tmp_path: pathlib.Path) -> None:
+    local = spool.LocalSpool(str(tmp_path))
+    local.put(b"one")
+    assert spool.drain(local, FakeEs(fail=True)) == 0
+    assert spool.drain(local, FakeEs(status=429)) == 0
+    assert len(local.list()) == 1
+    # Bad documents are logged and the segment is still removed
+    assert spool.drain(local, FakeEs(status=400)) == 1
+    assert local.list() == []